@@ -1,13 +1,12 @@
 import asyncio
 
-from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.messages import AIMessage
-from langchain_core.runnables import RunnableConfig, RunnableLambda, RunnableSerializable
+from langchain_core.runnables import Runnable, RunnableConfig
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import END, MessagesState, StateGraph
 
 from agents.bg_task_agent.task import Task
-from agents.models import models
+from agents.runnables import get_runnable
 
 
 class AgentState(MessagesState, total=False):
@@ -17,17 +16,16 @@ class AgentState(MessagesState, total=False):
     """
 
 
-def wrap_model(model: BaseChatModel) -> RunnableSerializable[AgentState, AIMessage]:
-    preprocessor = RunnableLambda(
-        lambda state: state["messages"],
-        name="StateModifier",
-    )
-    return preprocessor | model
+def get_messages(state: AgentState) -> list:
+    return state["messages"]
+
+
+def wrap_model(model_key: str) -> Runnable[AgentState, AIMessage]:
+    return get_runnable(model_key, "bg_task_agent", get_messages)
 
 
 async def acall_model(state: AgentState, config: RunnableConfig) -> AgentState:
-    m = models[config["configurable"].get("model", "gpt-4o-mini")]
-    model_runnable = wrap_model(m)
+    model_runnable = wrap_model(config["configurable"].get("model", "gpt-4o-mini"))
     response = await model_runnable.ainvoke(state, config)
 
     # We return a list, because this will get added to the existing list
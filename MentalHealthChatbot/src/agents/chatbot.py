@@ -1,30 +1,25 @@
-from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.messages import AIMessage
-from langchain_core.runnables import RunnableConfig, RunnableLambda, RunnableSerializable
+from langchain_core.runnables import Runnable, RunnableConfig
 from langgraph.checkpoint.memory import MemorySaver
-from langgraph.graph import END, MessagesState, StateGraph
+from langgraph.graph import END, StateGraph
 
-from agents.models import models
+from agents.runnables import get_runnable
+from agents.summarizer import SummaryState, prompt_messages, summarize_node
 
 
-class AgentState(MessagesState, total=False):
+class AgentState(SummaryState, total=False):
     """`total=False` is PEP589 specs.
 
     documentation: https://typing.readthedocs.io/en/latest/spec/typeddict.html#totality
     """
 
 
-def wrap_model(model: BaseChatModel) -> RunnableSerializable[AgentState, AIMessage]:
-    preprocessor = RunnableLambda(
-        lambda state: state["messages"],
-        name="StateModifier",
-    )
-    return preprocessor | model
+def wrap_model(model_key: str) -> Runnable[AgentState, AIMessage]:
+    return get_runnable(model_key, "chatbot", lambda state: prompt_messages(state, model_key))
 
 
 async def acall_model(state: AgentState, config: RunnableConfig) -> AgentState:
-    m = models[config["configurable"].get("model", "gpt-4o-mini")]
-    model_runnable = wrap_model(m)
+    model_runnable = wrap_model(config["configurable"].get("model", "gpt-4o-mini"))
     response = await model_runnable.ainvoke(state, config)
 
     # We return a list, because this will get added to the existing list
@@ -34,10 +29,12 @@ async def acall_model(state: AgentState, config: RunnableConfig) -> AgentState:
 # Define the graph
 agent = StateGraph(AgentState)
 agent.add_node("model", acall_model)
+agent.add_node("summarize", summarize_node)
 agent.set_entry_point("model")
 
 # Always END after blocking unsafe content
 agent.add_edge("model", END)
+agent.add_edge("summarize", END)
 
 chatbot = agent.compile(
     checkpointer=MemorySaver(),
@@ -0,0 +1,148 @@
+"""
+Single-flight coalescing of identical concurrent model calls.
+
+A double submit or a Streamlit rerun starts two identical graph runs, which
+would pay twice for the same nurse, triage and reply calls. While a call is in
+flight, identical calls (same model, messages, stop words and call options)
+join it instead of going to the provider: non-streaming callers share its
+result and streaming callers each get a copy of every token, including the
+ones produced before they joined.
+
+The provider call is cancelled only once every caller has gone away.
+"""
+import asyncio
+from typing import Any, AsyncIterator
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+from agents.wrappers import ChatModelWrapper, request_key
+from utils import metrics
+
+
+class _Flight:
+    """One in-flight provider call and the callers sharing it."""
+
+    def __init__(self) -> None:
+        self.task: asyncio.Task | None = None
+        self.subscribers = 0
+        self.chunks: list[ChatGenerationChunk] = []
+        self.done = False
+        self.error: BaseException | None = None
+        self.changed = asyncio.Event()
+
+    def notify(self) -> None:
+        self.changed.set()
+        self.changed = asyncio.Event()
+
+    def leave(self) -> None:
+        self.subscribers -= 1
+        if self.subscribers == 0 and not self.task.done():
+            self.task.cancel()
+
+
+class CoalescingChatModel(ChatModelWrapper):
+    """Shares one inner call among identical concurrent calls."""
+
+    model_key: str
+    calls: int = 0
+    coalesced: int = 0
+    flights: dict = {}
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.flights = {}
+
+    def _join(
+        self, kind: str, messages: list[BaseMessage], stop: list[str] | None, kwargs: dict
+    ) -> tuple[str, _Flight | None]:
+        key = request_key(kind, self.model_key, stop, kwargs, messages=messages)
+        self.calls += 1
+        flight = self.flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+            flight.subscribers += 1
+        return key, flight
+
+    def _start(self, key: str, flight: _Flight, coro) -> None:
+        flight.subscribers = 1
+        flight.task = asyncio.ensure_future(coro)
+        self.flights[key] = flight
+        flight.task.add_done_callback(
+            lambda _: self.flights.pop(key) if self.flights.get(key) is flight else None
+        )
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        key, flight = self._join("generate", messages, stop, kwargs)
+        if flight is None:
+            flight = _Flight()
+            # The shared call reports tokens to nobody; each caller's own run reports the result
+            self._start(key, flight, super()._agenerate(messages, stop=stop, **kwargs))
+        try:
+            result = await asyncio.shield(flight.task)
+            # Every caller annotates its own copy (message ids, metadata)
+            return result.copy(deep=True)
+        finally:
+            flight.leave()
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        key, flight = self._join("stream", messages, stop, kwargs)
+        if flight is None:
+            flight = _Flight()
+            self._start(key, flight, self._produce(flight, messages, stop, kwargs))
+        try:
+            sent = 0
+            while True:
+                while sent < len(flight.chunks):
+                    yield flight.chunks[sent].copy(deep=True)
+                    sent += 1
+                if flight.done:
+                    if flight.error is not None:
+                        raise flight.error
+                    return
+                await flight.changed.wait()
+        finally:
+            flight.leave()
+
+    async def _produce(
+        self, flight: _Flight, messages: list[BaseMessage], stop: list[str] | None, kwargs: dict
+    ) -> None:
+        try:
+            async for chunk in super()._astream(messages, stop=stop, **kwargs):
+                flight.chunks.append(chunk)
+                flight.notify()
+        except BaseException as e:
+            flight.error = e
+            if isinstance(e, asyncio.CancelledError):
+                raise
+        finally:
+            flight.done = True
+            flight.notify()
+
+    def stats(self) -> dict:
+        return {"calls": self.calls, "coalesced": self.coalesced, "in_flight": len(self.flights)}
+
+
+coalescing_models: dict[str, CoalescingChatModel] = {}
+
+
+def coalesced(name: str, inner: BaseChatModel) -> CoalescingChatModel:
+    coalescing_models[name] = CoalescingChatModel(inner=inner, model_key=name)
+    return coalescing_models[name]
+
+
+metrics.register("llm_coalescing", lambda: {name: m.stats() for name, m in coalescing_models.items()})
@@ -3,20 +3,15 @@ from datetime import datetime
 from typing import Literal
 
 from langchain_community.tools import DuckDuckGoSearchResults, OpenWeatherMapQueryRun
-from langchain_core.language_models.chat_models import BaseChatModel
 from langchain_core.messages import AIMessage, SystemMessage
-from langchain_core.runnables import (
-    RunnableConfig,
-    RunnableLambda,
-    RunnableSerializable,
-)
+from langchain_core.runnables import Runnable, RunnableConfig
 from langgraph.checkpoint.memory import MemorySaver
 from langgraph.graph import END, MessagesState, StateGraph
 from langgraph.managed import IsLastStep
 from langgraph.prebuilt import ToolNode
 
-from agents.llama_guard import LlamaGuard, LlamaGuardOutput, SafetyAssessment
-from agents.models import models
+from agents.llama_guard import LlamaGuardOutput, SafetyAssessment, get_llama_guard
+from agents.runnables import get_runnable
 from agents.tools import calculator
 
 
@@ -54,13 +49,12 @@ instructions = f"""
 
 
 # reference https://python.langchain.com/docs/how_to/functions/
-def wrap_model(model: BaseChatModel) -> RunnableSerializable[AgentState, AIMessage]:
-    model = model.bind_tools(tools)
-    preprocessor = RunnableLambda(
-        lambda state: [SystemMessage(content=instructions)] + state["messages"],
-        name="StateModifier",
-    )
-    return preprocessor | model
+def add_instructions(state: AgentState) -> list:
+    return [SystemMessage(content=instructions)] + state["messages"]
+
+
+def wrap_model(model_key: str) -> Runnable[AgentState, AIMessage]:
+    return get_runnable(model_key, "counsellor", add_instructions, tools=tools)
 
 
 def format_safety_message(safety: LlamaGuardOutput) -> AIMessage:
@@ -69,13 +63,14 @@ def format_safety_message(safety: LlamaGuardOutput) -> AIMessage:
 
 
 async def acall_model(state: AgentState, config: RunnableConfig) -> AgentState:
-    m = models[config["configurable"].get("model", "gpt-4o-mini")]
-    model_runnable = wrap_model(m)
+    model_runnable = wrap_model(config["configurable"].get("model", "gpt-4o-mini"))
     response = await model_runnable.ainvoke(state, config)
 
     # Run llama guard check here to avoid returning the message if it's unsafe
-    llama_guard = LlamaGuard()
-    safety_output = await llama_guard.ainvoke("Agent", state["messages"] + [response])
+    # The response is not in state yet, so it must not go into the thread's cached transcript
+    safety_output = await get_llama_guard().ainvoke(
+        "Agent", state["messages"], config["configurable"].get("thread_id"), partial=response
+    )
     if safety_output.safety_assessment == SafetyAssessment.UNSAFE:
         return {
             "messages": [format_safety_message(safety_output)],
@@ -100,8 +95,9 @@ async def emotion_analysis(state: AgentState) -> AgentState:
     return AIMessage(content=content)
 
 async def llama_guard_input(state: AgentState, config: RunnableConfig) -> AgentState:
-    llama_guard = LlamaGuard()
-    safety_output = await llama_guard.ainvoke("User", state["messages"])
+    safety_output = await get_llama_guard().ainvoke(
+        "User", state["messages"], config["configurable"].get("thread_id")
+    )
     return {"safety": safety_output}
 
 
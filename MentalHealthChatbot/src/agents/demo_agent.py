@@ -1,15 +1,18 @@
-from typing import Literal
+import asyncio
+import operator
+from typing import Annotated, Literal
 from rich import print
 from pydantic import BaseModel, Field
 from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_core.messages import AIMessage, SystemMessage
-from langchain_core.runnables import RunnableConfig, RunnableLambda
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.runnables import RunnableConfig
 from langgraph.checkpoint.memory import MemorySaver
-from langgraph.graph import END, MessagesState, StateGraph
+from langgraph.graph import END, StateGraph
 from agents.models import models
+from agents.runnables import get_runnable
+from agents.summarizer import SummaryState, prompt_messages, summarize_node
 from utils.gmail import send_email
 from utils.db import get_patient_by_user_id, insert_case
-from utils.rag import get_brain
 
 
 class NurseAnswer(BaseModel):
@@ -35,18 +38,61 @@ class NurseAnswer(BaseModel):
 patient_info = {}
 
 
-class EmotionAnswer(BaseModel):
+class TriageAnswer(BaseModel):
     emotional_tendency: Literal["positive", "negative"] = Field(
         description="Indicates whether the emotional tendency of the patient is positive or negative."
     )
-
-
-class DangerCheckAnswer(BaseModel):
     is_dangerous: bool = Field(
         description="Indicates whether the patient is dangerous and requires urgent attention."
     )
 
 
+class TriageScore(TriageAnswer):
+    message_id: str | None = None
+
+
+# Number of most recent tendencies kept verbatim in the triage summary
+TRIAGE_RECENT = 5
+
+
+class TriageSummary(BaseModel):
+    """Running aggregate of all triaged patient messages, updated in O(1) per turn."""
+
+    messages: int = 0
+    negative: int = 0
+    dangerous: int = 0
+    recent: list[str] = []
+
+    def update(self, answer: TriageAnswer) -> "TriageSummary":
+        tendency = answer.emotional_tendency + (" (dangerous)" if answer.is_dangerous else "")
+        return TriageSummary(
+            messages=self.messages + 1,
+            negative=self.negative + (answer.emotional_tendency == "negative"),
+            dangerous=self.dangerous + answer.is_dangerous,
+            recent=(self.recent + [tendency])[-TRIAGE_RECENT:],
+        )
+
+    def describe(self) -> str:
+        if not self.messages:
+            return "This is the first message from the patient."
+        return (
+            f"{self.messages} earlier patient messages were triaged: {self.negative} negative, "
+            f"{self.messages - self.negative} positive, {self.dangerous} flagged as dangerous. "
+            f"The latest {len(self.recent)}, oldest first: {', '.join(self.recent)}."
+        )
+
+
+class AgentState(SummaryState, total=False):
+    """`total=False` is PEP589 specs.
+
+    documentation: https://typing.readthedocs.io/en/latest/spec/typeddict.html#totality
+    """
+
+    triage: TriageAnswer
+    triage_scores: Annotated[list[TriageScore], operator.add]
+    triage_summary: TriageSummary
+
+
 def cus_print(level: str, tag: str, content: str):
     colors: dict = {
         "info": "blue",
@@ -66,20 +112,22 @@ def create_agent_instructions(role: str, examples: str) -> str:
 
 
 async def generic_agent(
-    role: str, examples: str, state: MessagesState, config: RunnableConfig
-) -> MessagesState:
+    role: str, examples: str, state: AgentState, config: RunnableConfig
+) -> AgentState:
     cus_print(
         "info",
         f"{role}_agent logic",
         "Creating agent instructions and initializing model.",
     )
-    model = models[config["configurable"].get("model", "gpt-4o-mini")]
     instructions = create_agent_instructions(role, examples)
 
-    preprocessor = RunnableLambda(
-        lambda state: [SystemMessage(content=instructions)] + state["messages"]
+    # Built once per model and role, see agents/runnables.py
+    model_key = config["configurable"].get("model", "gpt-4o-mini")
+    model_runnable = get_runnable(
+        model_key,
+        role,
+        lambda state: prompt_messages(state, model_key, instructions),
     )
-    model_runnable = preprocessor | model
     try:
         res = await model_runnable.ainvoke(state, config)
         cus_print("success", f"{role}_agent res", res.content)
@@ -115,7 +163,7 @@ Your responsibility is to assist in booking a psychiatrist for the patient. Once
 
 
 # Create a shared function for agents
-async def nurse(state: MessagesState, config: RunnableConfig) -> MessagesState:
+async def nurse(state: AgentState, config: RunnableConfig) -> AgentState:
     cus_print(
         "info", "nurse_agent logic", "Checking if all required information is provided."
     )
@@ -149,10 +197,10 @@ async def nurse(state: MessagesState, config: RunnableConfig) -> MessagesState:
             return {"messages": []}
     else:
         # If no existing info found or no user_id, proceed with LLM
-        llm = models[config["configurable"].get("model", "gpt-4o-mini")]
-        structured_llm = llm.with_structured_output(NurseAnswer)
+        model_key = config["configurable"].get("model", "gpt-4o-mini")
+        structured_llm = get_runnable(model_key, "nurse", schema=NurseAnswer)
         try:
-            res = await structured_llm.ainvoke(state["messages"])
+            res = await structured_llm.ainvoke(prompt_messages(state, model_key))
             if res.is_valid:
                 patient_info["name"] = res.name
                 patient_info["email"] = res.email
@@ -186,11 +234,51 @@ async def nurse(state: MessagesState, config: RunnableConfig) -> MessagesState:
             }
 
 
-async def counsellor(state: MessagesState, config: RunnableConfig) -> MessagesState:
-    return await generic_agent("counsellor", counsellor_examples, state, config)
+triage_instructions = """
+You are triaging a mental health conversation. {summary}
+Classify the emotional tendency of the patient's newest message, and whether the patient
+is dangerous and requires urgent attention, taking the earlier messages into account.
+"""
 
 
-async def psychologist(state: MessagesState, config: RunnableConfig) -> MessagesState:
+async def triage(state: AgentState, config: RunnableConfig) -> AgentState:
+    """
+    Classify emotional tendency and danger of the newest patient message in a
+    single structured call. Only that message and the running TriageSummary
+    are sent, so the cost of a turn does not grow with the conversation.
+    """
+    structured_llm = get_runnable(
+        config["configurable"].get("model", "gpt-4o-mini"), "triage", schema=TriageAnswer
+    )
+    summary = state.get("triage_summary") or TriageSummary()
+    newest = next(m for m in reversed(state["messages"]) if isinstance(m, HumanMessage))
+    cus_print("info", "triage logic", "Invoking structured LLM to check emotion and danger.")
+    try:
+        res = await structured_llm.ainvoke(
+            [SystemMessage(content=triage_instructions.format(summary=summary.describe())), newest]
+        )
+        cus_print("success", "triage result", str(res))
+    except Exception as e:
+        cus_print("error", "triage error", str(e))
+        # Routes this turn only; a made-up answer must not count towards the running aggregate
+        return {"triage": TriageAnswer(emotional_tendency="negative", is_dangerous=False)}
+    return {
+        "triage": res,
+        "triage_scores": [TriageScore(message_id=newest.id, **res.model_dump())],
+        "triage_summary": summary.update(res),
+    }
+
+
+async def counsellor(state: AgentState, config: RunnableConfig) -> AgentState:
+    # Triage runs alongside the reply, so routing is decided when the reply is done
+    reply, triage_update = await asyncio.gather(
+        generic_agent("counsellor", counsellor_examples, state, config),
+        triage(state, config),
+    )
+    return {**reply, **triage_update}
+
+
+async def psychologist(state: AgentState, config: RunnableConfig) -> AgentState:
     """
     Use RAG to provide professional psychological advice based on mental health knowledge base.
 
@@ -204,11 +292,17 @@ async def psychologist(state: MessagesState, config: RunnableConfig) -> Messages
     cus_print("info", "psychologist_agent", "Using RAG to provide professional advice")
 
     try:
-        # Get the last user message
-        last_message = state["messages"][-1].content
+        # Imported on first use: the RAG stack is heavy and only this node needs it
+        from utils.rag import get_brain
 
-        # Use the brain to generate a response
-        response = await get_brain(last_message)
+        # The patient's newest question; after the counsellor node the last message is its reply
+        question = next(m for m in reversed(state["messages"]) if isinstance(m, HumanMessage)).content
+
+        # Answer from the user's own knowledge base, or the global one (see utils/rag.py)
+        llm = models[config["configurable"].get("model", "gpt-4o-mini")]
+        user_id = config["configurable"].get("user_id")
+        # Generation streams under config, so /stream forwards the tokens as they arrive
+        response = await get_brain(question, llm, user_id, config)
 
         return {"messages": [AIMessage(content=response)]}
     except Exception as e:
@@ -220,7 +314,7 @@ async def psychologist(state: MessagesState, config: RunnableConfig) -> Messages
         }
 
 
-async def psychiatrist(state: MessagesState, config: RunnableConfig) -> MessagesState:
+async def psychiatrist(state: AgentState, config: RunnableConfig) -> AgentState:
     try:
         await send_email(patient_info)
         return {
@@ -240,16 +334,17 @@ async def psychiatrist(state: MessagesState, config: RunnableConfig) -> Messages
 
 
 # Define the graph
-agent = StateGraph(MessagesState)
+agent = StateGraph(AgentState)
 agent.set_entry_point("nurse")
 agent.add_node("nurse", nurse)
 agent.add_node("counsellor", counsellor)
 agent.add_node("psychologist", psychologist)
 agent.add_node("psychiatrist", psychiatrist)
+agent.add_node("summarize", summarize_node)
 
 
 async def check_identity(
-    state: MessagesState, config: RunnableConfig
+    state: AgentState, config: RunnableConfig
 ) -> Literal["completed", "incompleted"]:
     """
     Check if patient information exists in database using user_id from config.
@@ -271,37 +366,20 @@ async def check_identity(
 
 
 async def check_emotion(
-    state: MessagesState, config: RunnableConfig
+    state: AgentState, config: RunnableConfig
 ) -> Literal["positive", "negative"]:
-    llm = models[config["configurable"].get("model", "gpt-4o-mini")]
-    structured_llm = llm.with_structured_output(EmotionAnswer)
-    cus_print(
-        "info", "check_emotion logic", "Invoking structured LLM to check emotion."
-    )
-    try:
-        res = await structured_llm.ainvoke(state["messages"])
-        result = res.emotional_tendency
-        cus_print("success", "check_emotion result", result)
-        return result
-    except Exception as e:
-        cus_print("error", "check_emotion error", str(e))
-        return "negative"
+    # Decided by the triage that ran alongside the counsellor
+    result = state["triage"].emotional_tendency
+    cus_print("success", "check_emotion result", result)
+    return result
 
 
 async def check_danger(
-    state: MessagesState, config: RunnableConfig
+    state: AgentState, config: RunnableConfig
 ) -> Literal["dangerous", "safe"]:
-    llm = models[config["configurable"].get("model", "gpt-4o-mini")]
-    structured_llm = llm.with_structured_output(DangerCheckAnswer)
-    cus_print("info", "check_danger logic", "Invoking structured LLM to check danger.")
-    try:
-        res = await structured_llm.ainvoke(state["messages"])
-        result = "dangerous" if res.is_dangerous else "safe"
-        cus_print("success", "check_danger result", result)
-        return result
-    except Exception as e:
-        cus_print("error", "check_danger error", str(e))
-        return "safe"
+    result = "dangerous" if state["triage"].is_dangerous else "safe"
+    cus_print("success", "check_danger result", result)
+    return result
 
 
 # Update graph with new conditional edges
@@ -321,6 +399,7 @@ agent.add_conditional_edges(
     {"dangerous": "psychiatrist", "safe": END},
 )
 agent.add_edge("psychiatrist", END)
+agent.add_edge("summarize", END)
 
 demo_agent = agent.compile(
     checkpointer=MemorySaver(),
@@ -0,0 +1,191 @@
+"""
+Deterministic offline chat model for load tests and benchmarks.
+
+It streams its reply token by token at TOKENS_PER_SECOND after a
+FIRST_TOKEN_DELAY, supports bind_tools and with_structured_output, and never
+touches the network, so benchmarks measure the graph, streaming and
+persistence layers rather than provider latency.
+
+Replies are driven by rules, read from the JSON file FAKE_MODEL_FIXTURES:
+
+    [
+        {"match": "weather", "tool_calls": [{"name": "Weather", "args": {"location": "Tokyo"}}]},
+        {"match": "hopeless|worthless", "content": "I'm sorry you are feeling this way."},
+        {"schema": "TriageAnswer", "match": "kill myself",
+         "args": {"emotional_tendency": "negative", "is_dangerous": true}}
+    ]
+
+`match` is a regex searched in the newest human message and may be omitted.
+Rules with a `schema` answer structured output calls for that schema; the
+others answer plain calls. Unmatched structured calls get the first allowed
+value of every field, unmatched plain calls echo the question.
+"""
+import asyncio
+import json
+import os
+import re
+import time
+from typing import Any, AsyncIterator, Callable, Iterator, Sequence
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import LanguageModelInput
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage, AIMessageChunk, BaseMessage, HumanMessage, ToolMessage
+from langchain_core.outputs import ChatGeneration, ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable
+from langchain_core.tools import BaseTool
+from langchain_core.utils.function_calling import convert_to_openai_tool
+
+TOKEN_RE = re.compile(r"\s*\S+")
+
+
+def default_args(parameters: dict) -> dict:
+    """The first allowed value of every field of a JSON schema."""
+    defaults = {"boolean": False, "integer": 0, "number": 0.0, "string": "fake", "array": []}
+    args = {}
+    for name, field in parameters.get("properties", {}).items():
+        if "enum" in field:
+            args[name] = field["enum"][0]
+        elif "anyOf" in field:
+            args[name] = defaults.get(field["anyOf"][0].get("type"))
+        else:
+            args[name] = defaults.get(field.get("type"))
+    return args
+
+
+class FakeChatModel(BaseChatModel):
+    tokens_per_second: float = 50.0
+    first_token_delay: float = 0.3
+    rules: list[dict] = []
+
+    @classmethod
+    def from_env(cls) -> "FakeChatModel":
+        rules = []
+        if path := os.getenv("FAKE_MODEL_FIXTURES"):
+            with open(path, encoding="utf-8") as f:
+                rules = json.load(f)
+        return cls(
+            tokens_per_second=float(os.getenv("FAKE_MODEL_TOKENS_PER_SECOND", "50")),
+            first_token_delay=float(os.getenv("FAKE_MODEL_FIRST_TOKEN_DELAY", "0.3")),
+            rules=rules,
+        )
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake"
+
+    def bind_tools(
+        self,
+        tools: Sequence[dict[str, Any] | type | Callable | BaseTool],
+        *,
+        tool_choice: str | None = None,
+        **kwargs: Any,
+    ) -> Runnable[LanguageModelInput, BaseMessage]:
+        formatted = [convert_to_openai_tool(tool) for tool in tools]
+        return self.bind(tools=formatted, tool_choice=tool_choice, **kwargs)
+
+    def _match(self, messages: list[BaseMessage], schema: str | None) -> dict:
+        question = next(
+            (m.content for m in reversed(messages) if isinstance(m, HumanMessage)), ""
+        )
+        for rule in self.rules:
+            if rule.get("schema") == schema and re.search(
+                rule.get("match", ""), str(question), re.IGNORECASE
+            ):
+                return rule
+        return {} if schema else {"content": f"This is a fake reply to: {question}"}
+
+    def _reply(
+        self,
+        messages: list[BaseMessage],
+        tools: list[dict] | None = None,
+        tool_choice: str | None = None,
+        **kwargs: Any,
+    ) -> AIMessage:
+        tools = tools or []
+        # with_structured_output forces a call to its single schema tool
+        if tools and tool_choice not in (None, "auto", "none"):
+            tool = next(
+                (t for t in tools if t["function"]["name"] == tool_choice), tools[0]
+            )["function"]
+            rule = self._match(messages, tool["name"])
+            args = rule.get("args") or default_args(tool.get("parameters", {}))
+            return AIMessage(
+                content="", tool_calls=[{"name": tool["name"], "args": args, "id": "call_fake"}]
+            )
+        rule = self._match(messages, None)
+        # Tool calls only if the tool is bound, and never right after its result
+        names = {t["function"]["name"] for t in tools}
+        tool_calls = [
+            {"name": call["name"], "args": call.get("args", {}), "id": f"call_fake_{i}"}
+            for i, call in enumerate(rule.get("tool_calls", []))
+            if call["name"] in names
+        ]
+        if tool_calls and not isinstance(messages[-1], ToolMessage):
+            return AIMessage(content=rule.get("content", ""), tool_calls=tool_calls)
+        return AIMessage(content=rule.get("content", "OK"))
+
+    def _chunks(self, message: AIMessage) -> list[AIMessageChunk]:
+        chunks = [AIMessageChunk(content=token) for token in TOKEN_RE.findall(message.content)]
+        if message.tool_calls:
+            chunks.append(
+                AIMessageChunk(
+                    content="",
+                    tool_call_chunks=[
+                        {"name": c["name"], "args": json.dumps(c["args"]), "id": c["id"], "index": i}
+                        for i, c in enumerate(message.tool_calls)
+                    ],
+                )
+            )
+        return chunks or [AIMessageChunk(content="")]
+
+    def _generation_time(self, message: AIMessage) -> float:
+        return self.first_token_delay + len(self._chunks(message)) / self.tokens_per_second
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        message = self._reply(messages, **kwargs)
+        time.sleep(self._generation_time(message))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        message = self._reply(messages, **kwargs)
+        await asyncio.sleep(self._generation_time(message))
+        return ChatResult(generations=[ChatGeneration(message=message)])
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        time.sleep(self.first_token_delay)
+        for i, chunk in enumerate(self._chunks(self._reply(messages, **kwargs))):
+            if i:
+                time.sleep(1 / self.tokens_per_second)
+            yield ChatGenerationChunk(message=chunk)
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        await asyncio.sleep(self.first_token_delay)
+        for i, chunk in enumerate(self._chunks(self._reply(messages, **kwargs))):
+            if i:
+                await asyncio.sleep(1 / self.tokens_per_second)
+            yield ChatGenerationChunk(message=chunk)
@@ -1,17 +1,27 @@
+import importlib
+from typing import Callable
+
 from langgraph.graph.state import CompiledStateGraph
 
-from agents.bg_task_agent.bg_task_agent import bg_task_agent
-from agents.chatbot import chatbot
-from agents.research_assistant import research_assistant
-from agents.counsellor import counsellor
-from agents.demo_agent import demo_agent
+from utils import metrics
+from utils.lazy import LazyMapping
+
 DEFAULT_AGENT = "demo_agent"
 
 
-agents: dict[str, CompiledStateGraph] = {
-    "chatbot": chatbot,
-    "research-assistant": research_assistant,
-    "bg-task-agent": bg_task_agent,
-    "counsellor": counsellor,
-    "demo_agent": demo_agent,
-}
+def _load(module: str, name: str) -> Callable[[], CompiledStateGraph]:
+    # Importing the module builds its tools and compiles the graph
+    return lambda: getattr(importlib.import_module(module), name)
+
+
+agents: LazyMapping[CompiledStateGraph] = LazyMapping(
+    {
+        "chatbot": _load("agents.chatbot", "chatbot"),
+        "research-assistant": _load("agents.research_assistant", "research_assistant"),
+        "bg-task-agent": _load("agents.bg_task_agent.bg_task_agent", "bg_task_agent"),
+        "counsellor": _load("agents.counsellor", "counsellor"),
+        "demo_agent": _load("agents.demo_agent", "demo_agent"),
+    }
+)
+
+metrics.register("agents", agents.stats)
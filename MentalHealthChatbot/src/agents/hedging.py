@@ -0,0 +1,153 @@
+"""
+Hedged requests: fall back to another provider when the first token is slow.
+
+A HedgedChatModel streams from its model as usual, but if no token has arrived
+by the deadline it also starts the same request on an alternate model, keeps
+whichever stream produces a token first and cancels the other. The deadline is
+the LLM_HEDGE_PERCENTILE of recent first-token latencies, so only the slowest
+few percent of calls are duplicated.
+
+Hedging is enabled per model key, e.g.
+    LLM_HEDGE_ALTERNATES="gpt-4o-mini=claude-3-haiku"
+
+Calls with provider-specific options such as bound tools or structured output
+are never hedged, since the alternate could not understand them.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, AsyncIterator
+
+import numpy as np
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel, agenerate_from_stream
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+from agents.wrappers import ChatModelWrapper
+from utils import metrics
+
+PERCENTILE = float(os.getenv("LLM_HEDGE_PERCENTILE", "95"))
+# Used until MIN_SAMPLES first-token latencies have been observed
+DEFAULT_DEADLINE = float(os.getenv("LLM_HEDGE_DEFAULT_DEADLINE", "2.0"))
+MIN_DEADLINE = 0.2
+MIN_SAMPLES = 20
+WINDOW = 500
+
+
+async def _close(stream: AsyncIterator, first: asyncio.Future) -> None:
+    if not first.done():
+        first.cancel()
+        try:
+            await first
+        except BaseException:
+            pass
+    try:
+        await stream.aclose()
+    except BaseException:
+        pass
+
+
+class HedgedChatModel(ChatModelWrapper):
+    """Races `alternate` against the inner model when its first token is late."""
+
+    alternate: str
+    first_token_seconds: deque = deque()
+    calls: int = 0
+    hedged: int = 0
+    alternate_wins: int = 0
+
+    def __init__(self, **kwargs: Any) -> None:
+        super().__init__(**kwargs)
+        self.first_token_seconds = deque(maxlen=WINDOW)
+
+    def deadline(self) -> float:
+        if len(self.first_token_seconds) < MIN_SAMPLES:
+            return DEFAULT_DEADLINE
+        return max(MIN_DEADLINE, float(np.percentile(self.first_token_seconds, PERCENTILE)))
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        if kwargs:
+            return await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        return await agenerate_from_stream(self._astream(messages, stop=stop))
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        if kwargs:
+            async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                yield chunk
+            return
+
+        from agents.models import models
+
+        self.calls += 1
+        started_at = time.perf_counter()
+        stream = self.inner._astream(messages, stop=stop)
+        first = asyncio.ensure_future(stream.__anext__())
+        loser = None
+        try:
+            done, _ = await asyncio.wait({first}, timeout=self.deadline())
+            if not done:
+                self.hedged += 1
+                alt_stream = models[self.alternate]._astream(messages, stop=stop)
+                alt_first = asyncio.ensure_future(alt_stream.__anext__())
+                racers = {first: stream, alt_first: alt_stream}
+                done, _ = await asyncio.wait(racers, return_when=asyncio.FIRST_COMPLETED)
+                winner = next(iter(done))
+                other = alt_first if winner is first else first
+                # A stream that failed does not win while the other one may still succeed
+                if winner.exception() is not None and not other.done():
+                    await asyncio.wait({other})
+                    winner, other = other, winner
+                if winner is alt_first:
+                    self.alternate_wins += 1
+                loser = (racers[other], other)
+                stream, first = racers[winner], winner
+            # For hedged calls this is a lower bound of the model's own latency
+            self.first_token_seconds.append(time.perf_counter() - started_at)
+            if loser is not None:
+                await _close(*loser)
+                loser = None
+            try:
+                chunk = first.result()
+            except StopAsyncIteration:
+                return
+            yield chunk
+            async for chunk in stream:
+                yield chunk
+        finally:
+            if loser is not None:
+                await _close(*loser)
+            await _close(stream, first)
+
+    def stats(self) -> dict:
+        return {
+            "alternate": self.alternate,
+            "deadline_seconds": round(self.deadline(), 3),
+            "calls": self.calls,
+            "hedged": self.hedged,
+            "alternate_wins": self.alternate_wins,
+        }
+
+
+hedged_models: dict[str, HedgedChatModel] = {}
+
+
+def hedged(name: str, inner: BaseChatModel, alternate: str) -> HedgedChatModel:
+    hedged_models[name] = HedgedChatModel(inner=inner, alternate=alternate)
+    return hedged_models[name]
+
+
+metrics.register("llm_hedging", lambda: {name: m.stats() for name, m in hedged_models.items()})
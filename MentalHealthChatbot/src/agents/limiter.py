@@ -0,0 +1,180 @@
+"""
+Adaptive concurrency limit for every registered chat model.
+
+Each model key gets its own AIMD limiter: the number of concurrent calls grows
+by one per `limit` successful calls made at the limit (about +1 per round trip
+while it is the bottleneck; under light load it stays put) and is cut by
+BACKOFF on a rate limit, overload or timeout from the provider. Calls over the
+limit wait in a FIFO queue and fail with LimiterTimeout after LLM_MAX_WAIT
+seconds, so a traffic spike slows requests down instead of turning into a
+wave of 429s and retries.
+
+Only async calls are limited; the service never calls models synchronously.
+"""
+import asyncio
+import os
+import time
+from collections import deque
+from typing import Any, AsyncIterator
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+
+from agents.wrappers import ChatModelWrapper
+from utils import metrics
+
+INITIAL_LIMIT = float(os.getenv("LLM_CONCURRENCY_INITIAL", "8"))
+MIN_LIMIT = float(os.getenv("LLM_CONCURRENCY_MIN", "1"))
+MAX_LIMIT = float(os.getenv("LLM_CONCURRENCY_MAX", "64"))
+MAX_WAIT = float(os.getenv("LLM_MAX_WAIT", "30"))
+BACKOFF = 0.5
+# HTTP statuses providers use for rate limiting and overload
+OVERLOAD_STATUS = {429, 503, 529}
+
+
+class LimiterTimeout(TimeoutError):
+    pass
+
+
+def is_overload(error: BaseException) -> bool:
+    return (
+        getattr(error, "status_code", None) in OVERLOAD_STATUS
+        or isinstance(error, TimeoutError)
+        or "RateLimit" in type(error).__name__
+        or "Timeout" in type(error).__name__
+    )
+
+
+class AIMDLimiter:
+    def __init__(
+        self,
+        name: str,
+        initial: float = INITIAL_LIMIT,
+        min_limit: float = MIN_LIMIT,
+        max_limit: float = MAX_LIMIT,
+        max_wait: float = MAX_WAIT,
+    ) -> None:
+        self.name = name
+        self.limit = initial
+        self.min_limit = min_limit
+        self.max_limit = max_limit
+        self.max_wait = max_wait
+        self.in_flight = 0
+        self._waiters: deque[asyncio.Future] = deque()
+        self.completed = 0
+        self.overloads = 0
+        self.timeouts = 0
+        self.waits = 0
+        self.wait_seconds = 0.0
+        self.max_wait_seconds = 0.0
+
+    async def acquire(self) -> None:
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            return
+        started_at = time.perf_counter()
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        try:
+            # The slot is handed over by release(), which increments in_flight for us
+            await asyncio.wait_for(asyncio.shield(waiter), self.max_wait)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            self._abandon(waiter)
+            raise LimiterTimeout(f"{self.name}: no capacity within {self.max_wait:.0f}s")
+        except asyncio.CancelledError:
+            self._abandon(waiter)
+            raise
+        finally:
+            waited = time.perf_counter() - started_at
+            self.waits += 1
+            self.wait_seconds += waited
+            self.max_wait_seconds = max(self.max_wait_seconds, waited)
+
+    def _abandon(self, waiter: asyncio.Future) -> None:
+        if waiter.done() and not waiter.cancelled():
+            # The slot was handed over just as we gave up; pass it on
+            self.release(None)
+        else:
+            waiter.cancel()
+            self._waiters.remove(waiter)
+
+    def release(self, error: BaseException | None) -> None:
+        """Free a slot and adapt the limit to the outcome of the call."""
+        # Success only says the limit could be higher if the limit was what held calls back
+        at_limit = self.in_flight >= int(self.limit)
+        self.in_flight -= 1
+        if error is None:
+            self.completed += 1
+            if at_limit:
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        elif is_overload(error):
+            self.overloads += 1
+            self.limit = max(self.min_limit, self.limit * BACKOFF)
+        while self._waiters and self.in_flight < int(self.limit):
+            self.in_flight += 1
+            self._waiters.popleft().set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queue_depth": len(self._waiters),
+            "completed": self.completed,
+            "overloads": self.overloads,
+            "timeouts": self.timeouts,
+            "avg_wait_seconds": self.wait_seconds / self.waits if self.waits else 0.0,
+            "max_wait_seconds": self.max_wait_seconds,
+        }
+
+
+limiters: dict[str, AIMDLimiter] = {}
+
+
+class LimitedChatModel(ChatModelWrapper):
+    """Runs every async call of the inner model under its AIMD limiter."""
+
+    limiter: AIMDLimiter
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        await self.limiter.acquire()
+        try:
+            result = await super()._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+        except BaseException as e:
+            self.limiter.release(e)
+            raise
+        self.limiter.release(None)
+        return result
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        # The slot is held until the stream is exhausted
+        await self.limiter.acquire()
+        try:
+            async for chunk in super()._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+                yield chunk
+        except BaseException as e:
+            self.limiter.release(e)
+            raise
+        self.limiter.release(None)
+
+
+def limited(name: str, inner: BaseChatModel) -> LimitedChatModel:
+    limiters[name] = AIMDLimiter(name)
+    return LimitedChatModel(inner=inner, limiter=limiters[name])
+
+
+metrics.register("llm_limiter", lambda: {name: l.stats() for name, l in limiters.items()})
@@ -4,16 +4,66 @@ Target: check if unsafe content in 'Agent' or 'User'
 
 Logic: If GROQ_API_KEY, use ChatGroq() to guard output, else the content is default safe
 
+One LlamaGuard is shared per process (get_llama_guard). It keeps the rendered
+"User:/Agent:" transcript of each thread in an LRU and only renders the
+messages added since the last check, so building the guard prompt costs
+O(new messages) per turn instead of O(history).
+
+Before going remote, a local Prefilter scores the message being assessed:
+an Aho-Corasick automaton finds S1-S14 keywords in one pass and a small
+linear model turns the hits plus a few lexical features into a probability.
+Messages scoring below GUARD_PREFILTER_THRESHOLD are passed as safe without
+a remote call; everything else escalates to Llama Guard. Self-harm keywords in
+a User turn always escalate. The prefilter is off unless GUARD_PREFILTER=true.
+
+amoderate streams a response and checks it in windows while it is still being
+generated. The first window is GUARD_FIRST_WINDOW_TOKENS tokens, so the first
+tokens wait for little more than one guard round trip; each later window is
+twice as long, up to GUARD_WINDOW_TOKENS, and carries GUARD_WINDOW_OVERLAP
+tokens of the previous one for context. The service holds the tokens back and
+releases them window by window as they are judged safe; generation stops at
+the first unsafe window.
+
 https://python.langchain.com/docs/tutorials/extraction/
 """
+import asyncio
+import math
 import os
+import threading
+import time
+from collections import OrderedDict, deque
 from enum import Enum
+from typing import AsyncIterator
 
-from langchain_core.messages import AIMessage, AnyMessage, HumanMessage
+import numpy as np
+
+from langchain_core.messages import (
+    AIMessage,
+    AIMessageChunk,
+    AnyMessage,
+    HumanMessage,
+    message_chunk_to_message,
+)
 from langchain_core.prompts import PromptTemplate
+from langchain_core.runnables import RunnableConfig
 # from langchain_groq import ChatGroq
 from pydantic import BaseModel, Field
 
+from utils import metrics
+from utils.cus_data import release_tokens
+
+# Number of threads whose rendered transcript is kept
+TRANSCRIPT_CACHE_SIZE = int(os.getenv("GUARD_TRANSCRIPT_CACHE_SIZE", "1024"))
+# Off until the prefilter weights are fitted on labelled conversations
+PREFILTER_ENABLED = os.getenv("GUARD_PREFILTER", "false").lower() == "true"
+# Messages whose prefilter score is below this skip the remote guard
+PREFILTER_THRESHOLD = float(os.getenv("GUARD_PREFILTER_THRESHOLD", "0.2"))
+FIRST_WINDOW_TOKENS = int(os.getenv("GUARD_FIRST_WINDOW_TOKENS", "6"))
+WINDOW_TOKENS = int(os.getenv("GUARD_WINDOW_TOKENS", "48"))
+WINDOW_OVERLAP = int(os.getenv("GUARD_WINDOW_OVERLAP", "16"))
+# Same switch as for the registered models, see agents/models.py
+LIMIT_CONCURRENCY = os.getenv("LLM_LIMITER", "true").lower() == "true"
+
 
 class SafetyAssessment(Enum):
     SAFE = "safe"
@@ -82,42 +132,388 @@ def parse_llama_guard_output(output: str) -> LlamaGuardOutput:
         return LlamaGuardOutput(safety_assessment=SafetyAssessment.ERROR)
 
 
+# Lowercase keywords that make a message worth a remote check, by category
+category_keywords = {
+    "S1": ["kill", "murder", "stab", "shoot", "beat up", "beating up", "assault", "tortur", "kidnap", "strangl"],
+    "S2": ["steal", "robbery", "fraud", "scam", "launder", "hack into", "drugs", "meth", "cocaine", "heroin", "fentanyl"],
+    "S3": ["rape", "molest", "sexual assault", "trafficking"],
+    "S4": ["child porn", "underage", "minor sex", "groom"],
+    "S5": ["defame", "slander", "libel"],
+    "S6": ["dosage", "overdose", "prescription", "lethal dose", "diagnose me", "medication"],
+    "S7": ["home address", "social security", "phone number of", "dox", "password"],
+    "S8": ["pirate", "torrent", "crack software", "copyrighted"],
+    "S9": ["bomb", "explosiv", "nerve agent", "bioweapon", "anthrax", "nuclear weapon", "chemical weapon"],
+    "S10": ["hate", "inferior race", "slur", "nazi", "exterminate"],
+    "S11": [
+        "suicid", "kill myself", "killing myself", "kms", "end my life", "ending my life", "end it all",
+        "ending it all", "end it", "ending it", "take my life", "taking my life", "self harm", "self-harm",
+        "selfharm", "cut myself", "cutting myself", "cuts on my", "hurt myself", "hurting myself",
+        "harm myself", "harming myself", "overdos", "od on", "want to die", "wanna die", "wish i was dead",
+        "wish i were dead", "better off dead", "better off without me", "no reason to live",
+        "nothing to live for", "hang myself", "hanging myself", "jump off", "pills", "razor", "noose",
+    ],
+    "S12": ["porn", "nude", "sex", "erotic", "explicit"],
+    "S13": ["election", "ballot", "voting", "vote"],
+    "S14": ["exec(", "eval(", "os.system", "subprocess", "rm -rf", "import os", "__import__"],
+}
+
+
+# Keywords of these categories are stems and also match longer words ("kill" in "killing")
+prefix_categories = {"S1", "S9", "S11"}
+# Keywords of these categories in a User turn always escalate, whatever the score
+escalate_categories = {"S11"}
+
+
+class KeywordAutomaton:
+    """Aho-Corasick automaton matching every keyword in one pass over the text."""
+
+    def __init__(self, keywords: dict[str, list[str]], prefixes: set[str] = frozenset()) -> None:
+        self.prefixes = prefixes
+        self.goto: list[dict[str, int]] = [{}]
+        self.fail: list[int] = [0]
+        self.out: list[list[tuple[int, str]]] = [[]]
+        for category, words in keywords.items():
+            for word in words:
+                state = 0
+                for char in word:
+                    if char not in self.goto[state]:
+                        self.goto.append({})
+                        self.fail.append(0)
+                        self.out.append([])
+                        self.goto[state][char] = len(self.goto) - 1
+                    state = self.goto[state][char]
+                self.out[state].append((len(word), category))
+        queue = deque(self.goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, child in self.goto[state].items():
+                queue.append(child)
+                fallback = self.fail[state]
+                while fallback and char not in self.goto[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[child] = self.goto[fallback].get(char, 0)
+                self.out[child] = self.out[child] + self.out[self.fail[child]]
+
+    def matches(self, text: str) -> list[str]:
+        """
+        Categories of the keyword matches in `text`, one entry per match. Keywords
+        match whole words, except those of `prefixes`, which may be followed by
+        more letters.
+        """
+        text = text.lower()
+        found = []
+        state = 0
+        for end, char in enumerate(text):
+            while state and char not in self.goto[state]:
+                state = self.fail[state]
+            state = self.goto[state].get(char, 0)
+            for length, category in self.out[state]:
+                start = end - length + 1
+                before = text[start - 1] if start > 0 else " "
+                after = text[end + 1] if end + 1 < len(text) else " "
+                # Keywords ending in punctuation (exec() need no boundary after them
+                if not before.isalnum() and (
+                    not after.isalnum() or not text[end].isalnum() or category in self.prefixes
+                ):
+                    found.append(category)
+        return found
+
+
+class Prefilter:
+    """
+    Keyword hits and lexical features scored by a logistic model.
+
+    The weights are hand-set so that any keyword hit escalates and only long,
+    link-heavy or obfuscated messages escalate without one; they have not been
+    fitted on labelled data, which is why the prefilter is off by default.
+    """
+
+    categories = list(unsafe_content_categories)
+    lexical = ["log_length", "has_url", "non_ascii_ratio"]
+
+    def __init__(
+        self,
+        weights: np.ndarray | None = None,
+        bias: float = -4.0,
+        threshold: float = PREFILTER_THRESHOLD,
+    ) -> None:
+        self.automaton = KeywordAutomaton(category_keywords, prefix_categories)
+        if weights is None:
+            weights = np.array([4.0] * len(self.categories) + [0.3, 1.5, 4.0])
+        self.weights = weights
+        self.bias = bias
+        self.threshold = threshold
+
+    def features(self, texts: list[str], matches: list[list[str]] | None = None) -> np.ndarray:
+        if matches is None:
+            matches = [self.automaton.matches(text) for text in texts]
+        x = np.zeros((len(texts), len(self.categories) + len(self.lexical)))
+        for row, text in enumerate(texts):
+            for category in matches[row]:
+                x[row, self.categories.index(category)] += 1
+            offset = len(self.categories)
+            x[row, offset] = math.log1p(len(text))
+            x[row, offset + 1] = "http://" in text or "https://" in text
+            x[row, offset + 2] = sum(not c.isascii() for c in text) / len(text) if text else 0.0
+        # A repeated keyword is no more suspicious than three of them
+        np.clip(x[:, : len(self.categories)], 0, 3, out=x[:, : len(self.categories)])
+        return x
+
+    def scores(self, texts: list[str], matches: list[list[str]] | None = None) -> np.ndarray:
+        """Probability that each text needs the remote guard."""
+        return 1.0 / (1.0 + np.exp(-(self.features(texts, matches) @ self.weights + self.bias)))
+
+    def is_safe(self, text: str, role: str = "User") -> bool:
+        matches = self.automaton.matches(text)
+        if role == "User" and escalate_categories.intersection(matches):
+            return False
+        return bool(self.scores([text], [matches])[0] < self.threshold)
+
+
+def render_message(message: AnyMessage) -> str | None:
+    role_mapping = {"ai": "Agent", "human": "User"}
+    if message.type not in role_mapping:
+        return None
+    return f"{role_mapping[message.type]}: {message.content}"
+
+
 class LlamaGuard:
     def __init__(self) -> None:
+        self.model = None
+        self.prompt = PromptTemplate.from_template(llama_guard_instructions)
+        # thread_id -> (messages rendered, id of the last one, transcript)
+        self._transcripts: OrderedDict[str, tuple[int, str | None, str]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.transcript_hits = 0
+        self.transcript_misses = 0
+        self.prefilter = Prefilter() if PREFILTER_ENABLED else None
+        self.checks = 0
+        self.escalated = 0
+        self.remote_seconds = 0.0
         if os.getenv("GROQ_API_KEY") is None:
             print("GROQ_API_KEY not set, skipping LlamaGuard")
-            self.model = None
             return
-        # self.model = ChatGroq(model="llama-guard-3-8b", temperature=0.0).with_config(
-            # tags=["llama_guard"],
-        # )
-        self.prompt = PromptTemplate.from_template(llama_guard_instructions)
+        try:
+            from langchain_groq import ChatGroq
+        except ImportError:
+            print("langchain_groq not installed, skipping LlamaGuard")
+            return
+        model = ChatGroq(model="llama-guard-3-8b", temperature=0.0)
+        # The guard is the most frequent caller, so it gets an AIMD limiter like every registered model
+        if LIMIT_CONCURRENCY:
+            from agents.limiter import limited
+
+            model = limited("llama_guard", model)
+        self.model = model.with_config(tags=["llama_guard"])
+
+    def _transcript(self, messages: list[AnyMessage], thread_id: str | None) -> str:
+        """The rendered conversation, extending the thread's cached transcript if it still applies."""
+        count, transcript = 0, ""
+        if thread_id is not None:
+            with self._lock:
+                cached = self._transcripts.get(thread_id)
+            if cached is not None:
+                cached_count, last_id, cached_transcript = cached
+                if cached_count <= len(messages) and (
+                    cached_count == 0 or messages[cached_count - 1].id == last_id
+                ):
+                    count, transcript = cached_count, cached_transcript
+                    self.transcript_hits += 1
+                else:
+                    self.transcript_misses += 1
+            else:
+                self.transcript_misses += 1
+        new = [r for m in messages[count:] if (r := render_message(m)) is not None]
+        if new:
+            transcript = "\n\n".join([transcript, *new] if transcript else new)
+        if thread_id is not None and messages:
+            with self._lock:
+                self._transcripts[thread_id] = (len(messages), messages[-1].id, transcript)
+                self._transcripts.move_to_end(thread_id)
+                while len(self._transcripts) > TRANSCRIPT_CACHE_SIZE:
+                    self._transcripts.popitem(last=False)
+        return transcript
 
-    def _compile_prompt(self, role: str, messages: list[AnyMessage]) -> str:
-        role_mapping = {"ai": "Agent", "human": "User"}
-        messages_str = [
-            f"{role_mapping[m.type]}: {m.content}" for m in messages if m.type in ["ai", "human"]
-        ]
-        conversation_history = "\n\n".join(messages_str)
+    def _prefilter_safe(self, role: str, messages: list[AnyMessage]) -> bool:
+        """Whether the prefilter clears the last `role` message and the one before it."""
+        self.checks += 1
+        if self.prefilter is not None:
+            # The previous message gives context to short follow-ups ("yes, how?")
+            texts = [r for m in messages[-2:] if (r := render_message(m)) is not None]
+            if (
+                texts
+                and texts[-1].startswith(f"{role}: ")
+                and self.prefilter.is_safe("\n".join(texts), role)
+            ):
+                return True
+        self.escalated += 1
+        return False
+
+    def _compile_prompt(
+        self,
+        role: str,
+        messages: list[AnyMessage],
+        thread_id: str | None = None,
+        partial: AnyMessage | None = None,
+    ) -> str:
+        conversation_history = self._transcript(messages, thread_id)
+        # A partial response changes between checks, so it is never cached
+        if partial is not None and (rendered := render_message(partial)) is not None:
+            conversation_history = "\n\n".join(filter(None, [conversation_history, rendered]))
         return self.prompt.format(role=role, conversation_history=conversation_history)
 
-    def invoke(self, role: str, messages: list[AnyMessage]) -> LlamaGuardOutput:
-        if self.model is None:
+    def invoke(
+        self, role: str, messages: list[AnyMessage], thread_id: str | None = None
+    ) -> LlamaGuardOutput:
+        if self.model is None or self._prefilter_safe(role, messages):
             return LlamaGuardOutput(safety_assessment=SafetyAssessment.SAFE)
-        compiled_prompt = self._compile_prompt(role, messages)
+        started_at = time.perf_counter()
+        compiled_prompt = self._compile_prompt(role, messages, thread_id)
         result = self.model.invoke([HumanMessage(content=compiled_prompt)])
+        self.remote_seconds += time.perf_counter() - started_at
         return parse_llama_guard_output(result.content)
 
-    async def ainvoke(self, role: str, messages: list[AnyMessage]) -> LlamaGuardOutput:
-        if self.model is None:
+    async def ainvoke(
+        self,
+        role: str,
+        messages: list[AnyMessage],
+        thread_id: str | None = None,
+        partial: AnyMessage | None = None,
+    ) -> LlamaGuardOutput:
+        """`partial`, a response still being generated, is assessed as the last message."""
+        checked = messages if partial is None else [*messages, partial]
+        if self.model is None or self._prefilter_safe(role, checked):
             return LlamaGuardOutput(safety_assessment=SafetyAssessment.SAFE)
-        compiled_prompt = self._compile_prompt(role, messages)
+        started_at = time.perf_counter()
+        compiled_prompt = self._compile_prompt(role, messages, thread_id, partial)
         result = await self.model.ainvoke([HumanMessage(content=compiled_prompt)])
+        self.remote_seconds += time.perf_counter() - started_at
         return parse_llama_guard_output(result.content)
 
+    def stats(self) -> dict:
+        skipped = self.checks - self.escalated
+        mean_remote = self.remote_seconds / self.escalated if self.escalated else 0.0
+        return {
+            "enabled": self.model is not None,
+            "transcripts": len(self._transcripts),
+            "transcript_hits": self.transcript_hits,
+            "transcript_misses": self.transcript_misses,
+            "prefilter": self.prefilter is not None,
+            "checks": self.checks,
+            "escalated": self.escalated,
+            "escalation_rate": self.escalated / self.checks if self.checks else 0.0,
+            "mean_remote_seconds": round(mean_remote, 4),
+            # Estimated from the mean latency of the calls that did go remote
+            "seconds_saved": round(skipped * mean_remote, 3),
+        }
+
+
+_llama_guard: LlamaGuard | None = None
+_llama_guard_lock = threading.Lock()
+
+
+def get_llama_guard() -> LlamaGuard:
+    """The process-wide LlamaGuard, created on first use."""
+    global _llama_guard
+    with _llama_guard_lock:
+        if _llama_guard is None:
+            _llama_guard = LlamaGuard()
+            metrics.register("llama_guard", _llama_guard.stats)
+    return _llama_guard
+
+
+def content_text(content: str | list[str | dict]) -> str:
+    """The text of a message content, as the service streams it."""
+    if isinstance(content, str):
+        return content
+    return "".join(
+        item if isinstance(item, str) else item["text"]
+        for item in content
+        if isinstance(item, str) or item["type"] == "text"
+    )
+
+
+async def amoderate(
+    stream: AsyncIterator[AIMessageChunk],
+    messages: list[AnyMessage],
+    config: RunnableConfig,
+    release_after: asyncio.Future | None = None,
+) -> tuple[AIMessage, LlamaGuardOutput]:
+    """
+    Consume a response stream, checking it window by window as an "Agent" turn.
+
+    The stream's model must be tagged HOLD_TOKENS_TAG; approved windows are
+    released to the client in order, and not before `release_after` (e.g. a
+    pending input check) is done. Returns the response so far and the first
+    unsafe verdict, or the whole response and a safe one.
+    """
+    llama_guard = get_llama_guard()
+    thread_id = config["configurable"].get("thread_id")
+    response: AIMessageChunk | None = None
+    text = ""
+    # Text length at the end of each token, windows are cut on token boundaries
+    ends: list[int] = []
+    checks: deque[tuple[asyncio.Task, int]] = deque()
+    released = 0
+    safety = LlamaGuardOutput(safety_assessment=SafetyAssessment.SAFE)
+
+    def check(start_token: int) -> None:
+        start = ends[start_token - 1] if start_token > 0 else 0
+        window = AIMessage(content=text[start:])
+        checks.append(
+            (asyncio.ensure_future(llama_guard.ainvoke("Agent", messages, thread_id, window)), len(text))
+        )
+
+    async def settle(wait: bool) -> LlamaGuardOutput | None:
+        """Release the approved windows in order; the first unsafe verdict stops it."""
+        nonlocal released
+        while checks and (wait or checks[0][0].done()):
+            task, end = checks.popleft()
+            verdict = await task
+            if verdict.safety_assessment == SafetyAssessment.UNSAFE:
+                return verdict
+            if release_after is not None:
+                await release_after
+            released = end
+            await release_tokens(config, chars=released, final=False)
+        return None
+
+    window_start = 0
+    window_tokens = min(FIRST_WINDOW_TOKENS, WINDOW_TOKENS)
+    try:
+        async for chunk in stream:
+            response = chunk if response is None else response + chunk
+            if token := content_text(chunk.content):
+                text += token
+                ends.append(len(text))
+                if len(ends) - window_start >= window_tokens:
+                    check(max(0, window_start - WINDOW_OVERLAP))
+                    window_start = len(ends)
+                    window_tokens = min(2 * window_tokens, WINDOW_TOKENS)
+            if (verdict := await settle(wait=False)) is not None:
+                safety = verdict
+                break
+        else:
+            if window_start < len(ends):
+                check(max(0, window_start - WINDOW_OVERLAP))
+            if (verdict := await settle(wait=True)) is not None:
+                safety = verdict
+    finally:
+        for task, _ in checks:
+            task.cancel()
+        # Stops generation if it was cut off
+        await stream.aclose()
+    if safety.safety_assessment == SafetyAssessment.UNSAFE:
+        await release_tokens(config, chars=released)
+    else:
+        if release_after is not None:
+            await release_after
+        await release_tokens(config)
+    return message_chunk_to_message(response or AIMessageChunk(content="")), safety
+
 
 if __name__ == "__main__":
-    llama_guard = LlamaGuard()
+    llama_guard = get_llama_guard()
     output = llama_guard.invoke(
         "Agent",
         [
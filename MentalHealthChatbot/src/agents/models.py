@@ -1,26 +1,95 @@
 import os
+from typing import Callable
 
-from langchain_anthropic import ChatAnthropic
 from langchain_core.language_models.chat_models import BaseChatModel
-# from langchain_google_genai import ChatGoogleGenerativeAI
-# from langchain_groq import ChatGroq
-from langchain_openai import ChatOpenAI
+
+from utils import metrics
+from utils.lazy import LazyMapping
+
+# Providers are imported and constructed on first use of their key, see utils/lazy.py
+
+# Wrap every model in an adaptive concurrency limiter, see agents/limiter.py
+LIMIT_CONCURRENCY = os.getenv("LLM_LIMITER", "true").lower() == "true"
+COALESCE = os.getenv("LLM_COALESCE", "true").lower() == "true"
+HEDGE_ALTERNATES = dict(
+    item.split("=") for item in os.getenv("LLM_HEDGE_ALTERNATES", "").split(",") if item
+)
+
+
+def _gpt_4o_mini() -> BaseChatModel:
+    from langchain_openai import ChatOpenAI
+
+    return ChatOpenAI(model="gpt-4o-mini", temperature=0.5, streaming=True)
+
+
+# def _llama_3_1_70b() -> BaseChatModel:
+#     from langchain_groq import ChatGroq
+#
+#     return ChatGroq(model="llama-3.1-70b-versatile", temperature=0.5)
+
+
+# def _gemini_1_5_flash() -> BaseChatModel:
+#     from langchain_google_genai import ChatGoogleGenerativeAI
+#
+#     return ChatGoogleGenerativeAI(model="gemini-1.5-flash", temperature=0.5, streaming=True)
+
+
+def _claude_3_haiku() -> BaseChatModel:
+    from langchain_anthropic import ChatAnthropic
+
+    return ChatAnthropic(model="claude-3-haiku-20240307", temperature=0.5, streaming=True)
+
+
+def _fake() -> BaseChatModel:
+    from agents.fake_model import FakeChatModel
+
+    return FakeChatModel.from_env()
+
 
 # NOTE: models with streaming=True will send tokens as they are generated
 # if the /stream endpoint is called with stream_tokens=True (the default)
-models: dict[str, BaseChatModel] = {}
+models: LazyMapping[BaseChatModel] = LazyMapping()
+
+
+def _register(key: str, factory: Callable[[], BaseChatModel]) -> None:
+    def build() -> BaseChatModel:
+        model = factory()
+        if LIMIT_CONCURRENCY:
+            from agents.limiter import limited
+
+            model = limited(key, model)
+        # Race a slow first token against another provider, see agents/hedging.py
+        if key in HEDGE_ALTERNATES and HEDGE_ALTERNATES[key] in models:
+            from agents.hedging import hedged
+
+            model = hedged(key, model, HEDGE_ALTERNATES[key])
+        # Identical concurrent calls share one provider call, see agents/coalescing.py
+        if COALESCE:
+            from agents.coalescing import coalesced
+
+            model = coalesced(key, model)
+        return model
+
+    models.register(key, build)
+
+
 if os.getenv("OPENAI_API_KEY") is not None:
-    models["gpt-4o-mini"] = ChatOpenAI(model="gpt-4o-mini", temperature=0.5, streaming=True)
+    _register("gpt-4o-mini", _gpt_4o_mini)
 # if os.getenv("GROQ_API_KEY") is not None:
-#     models["llama-3.1-70b"] = ChatGroq(model="llama-3.1-70b-versatile", temperature=0.5)
+#     _register("llama-3.1-70b", _llama_3_1_70b)
 # if os.getenv("GOOGLE_API_KEY") is not None:
-#     models["gemini-1.5-flash"] = ChatGoogleGenerativeAI(
-#         model="gemini-1.5-flash", temperature=0.5, streaming=True
-#     )
+#     _register("gemini-1.5-flash", _gemini_1_5_flash)
 if os.getenv("ANTHROPIC_API_KEY") is not None:
-    models["claude-3-haiku"] = ChatAnthropic(
-        model="claude-3-haiku-20240307", temperature=0.5, streaming=True
-    )
+    _register("claude-3-haiku", _claude_3_haiku)
+
+# Offline model for load tests, see agents/fake_model.py
+if os.getenv("USE_FAKE_MODEL", "").lower() == "true":
+    _register("fake", _fake)
+    # Serve requests for the default model key too when no provider is configured
+    if "gpt-4o-mini" not in models:
+        models.register("gpt-4o-mini", lambda: models["fake"])
+
+metrics.register("models", models.stats)
 
 if not models:
     print("No LLM available. Please set environment variables to enable at least one LLM.")
@@ -1,22 +1,25 @@
+import asyncio
 import os
 from datetime import datetime
 from typing import Literal
 
 from langchain_community.tools import DuckDuckGoSearchResults, OpenWeatherMapQueryRun
-from langchain_core.language_models.chat_models import BaseChatModel
-from langchain_core.messages import AIMessage, SystemMessage
-from langchain_core.runnables import RunnableConfig, RunnableLambda, RunnableSerializable
+from langchain_core.messages import AIMessage
+from langchain_core.runnables import Runnable, RunnableConfig
+from langchain_core.runnables.config import merge_configs
 from langgraph.checkpoint.memory import MemorySaver
-from langgraph.graph import END, MessagesState, StateGraph
+from langgraph.graph import END, StateGraph
 from langgraph.managed import IsLastStep
 from langgraph.prebuilt import ToolNode
 
-from agents.llama_guard import LlamaGuard, LlamaGuardOutput, SafetyAssessment
-from agents.models import models
+from agents.llama_guard import LlamaGuardOutput, SafetyAssessment, amoderate, get_llama_guard
+from agents.runnables import get_runnable
+from agents.summarizer import SummaryState, prompt_messages, summarize_node
 from agents.tools import calculator
+from utils.cus_data import HOLD_TOKENS_TAG
 
 
-class AgentState(MessagesState, total=False):
+class AgentState(SummaryState, total=False):
     """`total=False` is PEP589 specs.
 
     documentation: https://typing.readthedocs.io/en/latest/spec/typeddict.html#totality
@@ -26,6 +29,9 @@ class AgentState(MessagesState, total=False):
     is_last_step: IsLastStep
 
 
+# Start generating while the input guard runs instead of after it
+OPTIMISTIC_GUARD = os.getenv("GUARD_OPTIMISTIC", "true").lower() == "true"
+
 web_search = DuckDuckGoSearchResults(name="WebSearch")
 tools = [web_search, calculator]
 
@@ -49,13 +55,13 @@ instructions = f"""
     """
 
 # reference https://python.langchain.com/docs/how_to/functions/
-def wrap_model(model: BaseChatModel) -> RunnableSerializable[AgentState, AIMessage]:
-    model = model.bind_tools(tools)
-    preprocessor = RunnableLambda(
-        lambda state: [SystemMessage(content=instructions)] + state["messages"],
-        name="StateModifier",
+def wrap_model(model_key: str) -> Runnable[AgentState, AIMessage]:
+    return get_runnable(
+        model_key,
+        "research_assistant",
+        lambda state: prompt_messages(state, model_key, instructions),
+        tools=tools,
     )
-    return preprocessor | model
 
 
 def format_safety_message(safety: LlamaGuardOutput) -> AIMessage:
@@ -65,14 +71,21 @@ def format_safety_message(safety: LlamaGuardOutput) -> AIMessage:
     return AIMessage(content=content)
 
 
-async def acall_model(state: AgentState, config: RunnableConfig) -> AgentState:
-    m = models[config["configurable"].get("model", "gpt-4o-mini")]
-    model_runnable = wrap_model(m)
-    response = await model_runnable.ainvoke(state, config)
-
-    # Run llama guard check here to avoid returning the message if it's unsafe
-    llama_guard = LlamaGuard()
-    safety_output = await llama_guard.ainvoke("Agent", state["messages"] + [response])
+async def acall_model(
+    state: AgentState, config: RunnableConfig, release_after: asyncio.Future | None = None
+) -> AgentState:
+    model_runnable = wrap_model(config["configurable"].get("model", "gpt-4o-mini"))
+    if get_llama_guard().model is None:
+        # No guard to wait for, the tokens stream to the client as they come
+        response = await model_runnable.ainvoke(state, config)
+        safety_output = LlamaGuardOutput(safety_assessment=SafetyAssessment.SAFE)
+    else:
+        # Check the response with llama guard while it streams, so tokens reach the
+        # client window by window and an unsafe response is cut off early
+        stream = model_runnable.astream(
+            state, merge_configs(config, RunnableConfig(tags=[HOLD_TOKENS_TAG]))
+        )
+        response, safety_output = await amoderate(stream, state["messages"], config, release_after)
     if safety_output.safety_assessment == SafetyAssessment.UNSAFE:
         return {"messages": [format_safety_message(safety_output)], "safety": safety_output}
 
@@ -90,11 +103,38 @@ async def acall_model(state: AgentState, config: RunnableConfig) -> AgentState:
 
 
 async def llama_guard_input(state: AgentState, config: RunnableConfig) -> AgentState:
-    llama_guard = LlamaGuard()
-    safety_output = await llama_guard.ainvoke("User", state["messages"])
+    safety_output = await get_llama_guard().ainvoke(
+        "User", state["messages"], config["configurable"].get("thread_id")
+    )
     return {"safety": safety_output}
 
 
+async def guarded_model(state: AgentState, config: RunnableConfig) -> AgentState:
+    """
+    Optimistic guard_input + model: both start together and no token of the
+    model is released to the client before the guard says the input is safe.
+    On unsafe input the model call is cancelled, so the safe path costs
+    max(guard, generation) instead of their sum.
+    """
+    guard = asyncio.ensure_future(
+        get_llama_guard().ainvoke("User", state["messages"], config["configurable"].get("thread_id"))
+    )
+    model = asyncio.ensure_future(acall_model(state, config, release_after=guard))
+    try:
+        safety_output = await guard
+        if safety_output.safety_assessment == SafetyAssessment.UNSAFE:
+            return {"messages": [format_safety_message(safety_output)], "safety": safety_output}
+        # An unsafe response carries its own verdict, which must not be replaced by the input's
+        return {"safety": safety_output, **await model}
+    finally:
+        if not model.done():
+            model.cancel()
+            try:
+                await model
+            except asyncio.CancelledError:
+                pass
+
+
 async def block_unsafe_content(state: AgentState, config: RunnableConfig) -> AgentState:
     safety: LlamaGuardOutput = state["safety"]
     return {"messages": [format_safety_message(safety)]}
@@ -106,7 +146,9 @@ agent.add_node("model", acall_model)
 agent.add_node("tools", ToolNode(tools))
 agent.add_node("guard_input", llama_guard_input)
 agent.add_node("block_unsafe_content", block_unsafe_content)
-agent.set_entry_point("guard_input")
+agent.add_node("guarded_model", guarded_model)
+agent.add_node("summarize", summarize_node)
+agent.set_entry_point("guarded_model" if OPTIMISTIC_GUARD else "guard_input")
 
 
 # Check for unsafe input and block further processing if found
@@ -126,6 +168,9 @@ agent.add_conditional_edges(
 # Always END after blocking unsafe content
 agent.add_edge("block_unsafe_content", END)
 
+# Summaries are written as "summarize" after a turn, see agents/summarizer.py
+agent.add_edge("summarize", END)
+
 # Always run "model" after "tools"
 agent.add_edge("tools", "model")
 
@@ -141,6 +186,8 @@ def pending_tool_calls(state: AgentState) -> Literal["tools", "done"]:
 
 
 agent.add_conditional_edges("model", pending_tool_calls, {"tools": "tools", "done": END})
+# A blocked input leaves the safety message last, which has no tool calls
+agent.add_conditional_edges("guarded_model", pending_tool_calls, {"tools": "tools", "done": END})
 
 research_assistant = agent.compile(
     checkpointer=MemorySaver(),
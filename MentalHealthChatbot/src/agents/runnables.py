@@ -0,0 +1,79 @@
+"""
+Registry of prebuilt model runnables.
+
+Binding tools, applying with_structured_output and piping a state
+preprocessor into a model all allocate a new chain. Node functions ask this
+registry instead of rebuilding it on every call: each (model, role, tools,
+schema) combination is built once per process and reused afterwards.
+"""
+import threading
+from typing import Any, Callable, Sequence
+
+from langchain_core.runnables import Runnable, RunnableBinding, RunnableLambda, RunnableSequence
+from langchain_core.tools import BaseTool
+
+from agents.models import models
+from agents.structured_cache import cached_structured
+from utils import metrics
+
+_runnables: dict[tuple, Runnable] = {}
+_lock = threading.Lock()
+counters = {"built": 0, "reused": 0}
+
+
+def get_runnable(
+    model_key: str,
+    role: str,
+    prepare: Callable[[Any], Any] | None = None,
+    *,
+    tools: Sequence[BaseTool] = (),
+    schema: type | None = None,
+) -> Runnable:
+    """
+    Return the runnable for `role` on `model_key`, building it on first use.
+
+    `prepare` maps the node input (usually the graph state) to the model
+    input; `role` must identify it, since it is not part of the cache key.
+    """
+    key = (model_key, role, tuple(tool.name for tool in tools), schema)
+    runnable = _runnables.get(key)
+    if runnable is not None:
+        counters["reused"] += 1
+        return runnable
+    with _lock:
+        if key not in _runnables:
+            model = models[model_key]
+            if tools:
+                model = model.bind_tools(tools)
+            if schema is not None:
+                model = _structured(model, model_key, schema)
+            if prepare is not None:
+                model = RunnableLambda(prepare, name="StateModifier") | model
+            _runnables[key] = model
+            counters["built"] += 1
+        else:
+            counters["reused"] += 1
+        return _runnables[key]
+
+
+def _structured(model: Runnable, model_key: str, schema: type) -> Runnable:
+    """
+    with_structured_output(schema) sampled at temperature 0, so its answers are
+    pure functions of the input and can be cached (see agents/structured_cache.py).
+    """
+    structured = model.with_structured_output(schema)
+    # Providers return model.bind(tools=...) | parser; the call kwargs go on that binding
+    if isinstance(structured, RunnableSequence) and isinstance(structured.first, RunnableBinding):
+        first = structured.first.bind(temperature=0)
+        return cached_structured(
+            RunnableSequence(first, *structured.middle, structured.last), model_key, schema
+        )
+    # A sampled answer must not be replayed as if it were the only one
+    return structured
+
+
+def stats() -> dict:
+    return {**counters, "cached": len(_runnables)}
+
+
+metrics.register("runnables", stats)
@@ -0,0 +1,153 @@
+"""
+Exact-match cache for structured-output calls (nurse extraction, triage).
+
+These calls are treated as pure functions of their input: retries, reconnects
+and the repeated nurse flow send identical messages and get the cached answer
+back without a provider call. Free-form replies are never cached.
+
+Keys are sha256 over the model key, the schema (name and JSON schema, so a
+changed schema never hits stale entries) and a canonical form of the messages
+that ignores message ids. Entries live in an in-memory LRU tier
+(STRUCTURED_CACHE_SIZE entries, STRUCTURED_CACHE_TTL seconds) and, if
+STRUCTURED_CACHE_PATH is set, in a SQLite tier shared across workers and
+restarts (STRUCTURED_CACHE_SQLITE_TTL seconds).
+"""
+import json
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from typing import Any
+
+from langchain_core.messages import HumanMessage, convert_to_messages
+from langchain_core.runnables import Runnable, RunnableConfig, RunnableLambda
+
+from agents.wrappers import request_key
+from utils import metrics
+
+MAX_ENTRIES = int(os.getenv("STRUCTURED_CACHE_SIZE", "10000"))
+TTL = float(os.getenv("STRUCTURED_CACHE_TTL", "600"))
+SQLITE_PATH = os.getenv("STRUCTURED_CACHE_PATH")
+SQLITE_TTL = float(os.getenv("STRUCTURED_CACHE_SQLITE_TTL", "86400"))
+
+
+def _schema_id(schema: type) -> str:
+    json_schema = schema.model_json_schema() if hasattr(schema, "model_json_schema") else schema.schema()
+    return f"{schema.__module__}.{schema.__qualname__}:{json.dumps(json_schema, sort_keys=True)}"
+
+
+class StructuredCache:
+    def __init__(
+        self,
+        max_entries: int = MAX_ENTRIES,
+        ttl: float = TTL,
+        path: str | None = SQLITE_PATH,
+        sqlite_ttl: float = SQLITE_TTL,
+    ) -> None:
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.path = path
+        self.sqlite_ttl = sqlite_ttl
+        self.memory_hits = 0
+        self.sqlite_hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, dict]] = OrderedDict()
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS structured_cache
+                   (key TEXT PRIMARY KEY, value TEXT, expires_at REAL) WITHOUT ROWID"""
+            )
+            self._local.conn = conn
+        return conn
+
+    def get(self, key: str) -> dict | None:
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return entry[1]
+            self._entries.pop(key, None)
+        if self.path:
+            row = self.conn.execute(
+                "SELECT value FROM structured_cache WHERE key = ? AND expires_at > ?", (key, now)
+            ).fetchone()
+            if row is not None:
+                value = json.loads(row[0])
+                self._remember(key, value, now)
+                self.sqlite_hits += 1
+                return value
+        self.misses += 1
+        return None
+
+    def put(self, key: str, value: dict) -> None:
+        now = time.time()
+        self._remember(key, value, now)
+        if self.path:
+            with self.conn:
+                self.conn.execute(
+                    "INSERT OR REPLACE INTO structured_cache (key, value, expires_at) VALUES (?, ?, ?)",
+                    (key, json.dumps(value), now + self.sqlite_ttl),
+                )
+
+    def _remember(self, key: str, value: dict, now: float) -> None:
+        with self._lock:
+            self._entries[key] = (now + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self) -> dict:
+        lookups = self.memory_hits + self.sqlite_hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "memory_hits": self.memory_hits,
+            "sqlite_hits": self.sqlite_hits,
+            "misses": self.misses,
+            "hit_rate": (lookups - self.misses) / lookups if lookups else 0.0,
+        }
+
+
+structured_cache = StructuredCache()
+metrics.register("structured_cache", structured_cache.stats)
+
+
+def structured_key(input: Any, model_key: str, schema: type) -> str:
+    """The cache key of a structured call of `model_key` with `schema` on `input`."""
+    messages = convert_to_messages(input) if isinstance(input, list) else [HumanMessage(str(input))]
+    return request_key(model_key, _schema_id(schema), messages=messages)
+
+
+def cached_structured(runnable: Runnable, model_key: str, schema: type) -> Runnable:
+    """Serve `runnable`, a with_structured_output(schema) chain, from the cache."""
+
+    def to_dict(result: Any) -> dict:
+        return result.model_dump() if hasattr(result, "model_dump") else result.dict()
+
+    def invoke(input: Any, config: RunnableConfig) -> Any:
+        key = structured_key(input, model_key, schema)
+        if (value := structured_cache.get(key)) is not None:
+            return schema(**value)
+        result = runnable.invoke(input, config)
+        structured_cache.put(key, to_dict(result))
+        return result
+
+    async def ainvoke(input: Any, config: RunnableConfig) -> Any:
+        key = structured_key(input, model_key, schema)
+        if (value := structured_cache.get(key)) is not None:
+            return schema(**value)
+        result = await runnable.ainvoke(input, config)
+        structured_cache.put(key, to_dict(result))
+        return result
+
+    return RunnableLambda(invoke, afunc=ainvoke, name=f"Cached{schema.__name__}")
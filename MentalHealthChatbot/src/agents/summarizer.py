@@ -0,0 +1,172 @@
+"""
+Rolling conversation summarization, so prompts stay bounded as threads grow.
+
+Agents keep two extra state fields: `summary`, a running summary of the
+conversation, and `summary_cursor`, the index of the first message it does not
+cover. Nodes build their prompt with `prompt_messages`: one system message with
+the node's instructions and the summary, then the messages from the cursor on,
+trimmed to the token budget of the model. Some providers (Anthropic) reject a
+system message anywhere but first, so instructions must not be prepended.
+
+After a turn has been answered the service calls `schedule`, which folds every
+message older than the last SUMMARY_KEEP_TURNS human turns into the summary in
+a background task and writes it back with `aupdate_state(as_node="summarize")`.
+Graphs therefore need a pass-through "summarize" node wired to END.
+
+Token budgets per model are configured as, e.g.
+    SUMMARY_TOKEN_BUDGETS="gpt-4o-mini=4000,claude-3-haiku=3000"
+"""
+import asyncio
+import logging
+import os
+
+from langchain_core.messages import (
+    AnyMessage,
+    HumanMessage,
+    SystemMessage,
+    get_buffer_string,
+    trim_messages,
+)
+from langchain_core.runnables import RunnableConfig
+from langgraph.graph import MessagesState
+from langgraph.graph.state import CompiledStateGraph
+
+from agents.models import models
+from utils import metrics
+
+logger = logging.getLogger(__name__)
+
+KEEP_TURNS = int(os.getenv("SUMMARY_KEEP_TURNS", "4"))
+DEFAULT_TOKEN_BUDGET = int(os.getenv("SUMMARY_TOKEN_BUDGET", "3000"))
+TOKEN_BUDGETS = {
+    model: int(budget)
+    for model, budget in (
+        item.split("=") for item in os.getenv("SUMMARY_TOKEN_BUDGETS", "").split(",") if item
+    )
+}
+# Rough token estimate; exact counting is not worth a tokenizer call per turn
+CHARS_PER_TOKEN = 4
+
+summarize_instructions = """
+You maintain a running summary of a conversation between a patient and a mental health assistant.
+Extend the current summary with the new messages. Keep facts about the patient, their feelings
+and concerns, advice already given and open questions. Answer with the updated summary only,
+in at most 200 words.
+"""
+
+
+class SummaryState(MessagesState, total=False):
+    summary: str
+    summary_cursor: int
+
+
+def token_budget(model_key: str) -> int:
+    return TOKEN_BUDGETS.get(model_key, DEFAULT_TOKEN_BUDGET)
+
+
+def count_tokens(messages: list[AnyMessage]) -> int:
+    return sum(len(get_buffer_string([m])) for m in messages) // CHARS_PER_TOKEN
+
+
+def prompt_messages(
+    state: SummaryState, model_key: str, instructions: str | None = None
+) -> list[AnyMessage]:
+    """
+    The instructions and summary as a single leading system message, plus the
+    unsummarized messages that fit in the model's budget.
+    """
+    messages = state["messages"][state.get("summary_cursor", 0) :]
+    trimmed = trim_messages(
+        messages,
+        max_tokens=token_budget(model_key),
+        token_counter=count_tokens,
+        strategy="last",
+        start_on="human",
+    )
+    if not trimmed:
+        # The current turn is always sent whole, even if it alone is over budget:
+        # cutting into it could leave tool results without the AI tool call they answer
+        humans = [i for i, m in enumerate(messages) if isinstance(m, HumanMessage)]
+        trimmed = messages[humans[-1] :] if humans else messages
+    system = [instructions] if instructions else []
+    if state.get("summary"):
+        system.append(f"Summary of the earlier conversation: {state['summary']}")
+    if system:
+        return [SystemMessage(content="\n\n".join(system))] + trimmed
+    return trimmed
+
+
+def summarize_node(state: SummaryState) -> SummaryState:
+    """Pass-through node that summary updates are written as."""
+    return {}
+
+
+def _boundary(messages: list[AnyMessage]) -> int:
+    """Index of the first message of the last KEEP_TURNS human turns."""
+    turns = [i for i, m in enumerate(messages) if isinstance(m, HumanMessage)]
+    return turns[-KEEP_TURNS] if len(turns) > KEEP_TURNS else 0
+
+
+counters = {"runs": 0, "summarized_messages": 0, "skipped": 0, "errors": 0}
+_running: dict[str, asyncio.Task] = {}
+
+
+async def summarize(agent: CompiledStateGraph, config: RunnableConfig) -> None:
+    """Fold messages older than the last KEEP_TURNS turns into the thread summary."""
+    values = (await agent.aget_state(config)).values
+    messages = values.get("messages", [])
+    cursor = values.get("summary_cursor", 0)
+    boundary = _boundary(messages)
+    if boundary <= cursor:
+        return
+    model = models[config["configurable"].get("model", "gpt-4o-mini")]
+    transcript = get_buffer_string(messages[cursor:boundary], human_prefix="Patient")
+    response = await model.ainvoke(
+        [
+            SystemMessage(content=summarize_instructions),
+            HumanMessage(
+                content=f"Current summary:\n{values.get('summary', '')}\n\nNew messages:\n{transcript}"
+            ),
+        ]
+    )
+    await agent.aupdate_state(
+        config,
+        {"summary": response.content, "summary_cursor": boundary},
+        as_node="summarize",
+    )
+    counters["runs"] += 1
+    counters["summarized_messages"] += boundary - cursor
+
+
+def schedule(agent: CompiledStateGraph, config: RunnableConfig) -> None:
+    """Summarize the thread in the background; at most one run per thread at a time."""
+    if "summarize" not in agent.nodes:
+        return
+    thread_id = config["configurable"]["thread_id"]
+    if thread_id in _running:
+        counters["skipped"] += 1
+        return
+    # Only the thread and model are needed; callbacks and run_id belong to the finished turn
+    config = RunnableConfig(
+        configurable={
+            "thread_id": thread_id,
+            "model": config["configurable"].get("model", "gpt-4o-mini"),
+        }
+    )
+    task = asyncio.create_task(summarize(agent, config))
+    _running[thread_id] = task
+    task.add_done_callback(lambda t: _finished(thread_id, t))
+
+
+def _finished(thread_id: str, task: asyncio.Task) -> None:
+    del _running[thread_id]
+    if not task.cancelled() and task.exception() is not None:
+        counters["errors"] += 1
+        logger.error(f"Summarizing thread {thread_id} failed: {task.exception()}")
+
+
+def stats() -> dict:
+    return {**counters, "running": len(_running)}
+
+
+metrics.register("summarizer", stats)
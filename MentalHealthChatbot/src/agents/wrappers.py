@@ -0,0 +1,96 @@
+"""
+Base class for chat models that wrap another chat model.
+
+Subclasses override the generation hooks to add behaviour around the inner
+model (limiting, hedging, caching...) while everything else, including
+bind_tools and with_structured_output, keeps working: tools are formatted by
+the inner model and bound to the wrapper, so calls still go through it.
+
+Only the private generation hooks are delegated, so callbacks and streaming
+events are reported once, by the wrapper's own run.
+"""
+import hashlib
+import json
+from typing import Any, AsyncIterator, Callable, Iterator, Sequence
+
+from langchain_core.callbacks import AsyncCallbackManagerForLLMRun, CallbackManagerForLLMRun
+from langchain_core.language_models import LanguageModelInput
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import BaseMessage
+from langchain_core.outputs import ChatGenerationChunk, ChatResult
+from langchain_core.runnables import Runnable
+from langchain_core.tools import BaseTool
+
+
+def canonical_messages(messages: list[BaseMessage]) -> list[dict]:
+    """What a model actually sees of the messages; ids and metadata are dropped."""
+    return [
+        {"type": m.type, "content": m.content, "tool_calls": getattr(m, "tool_calls", [])}
+        for m in messages
+    ]
+
+
+def request_key(*parts: Any, messages: list[BaseMessage]) -> str:
+    payload = json.dumps([*parts, canonical_messages(messages)], sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ChatModelWrapper(BaseChatModel):
+    inner: BaseChatModel
+
+    @property
+    def _llm_type(self) -> str:
+        return self.inner._llm_type
+
+    @property
+    def _identifying_params(self) -> dict[str, Any]:
+        return self.inner._identifying_params
+
+    @property
+    def model_name(self) -> str:
+        """The provider's model name (ChatOpenAI.model_name, ChatAnthropic.model), for per-model scopes."""
+        return getattr(self.inner, "model_name", None) or getattr(self.inner, "model", "")
+
+    def bind_tools(
+        self,
+        tools: Sequence[dict[str, Any] | type | Callable | BaseTool],
+        **kwargs: Any,
+    ) -> Runnable[LanguageModelInput, BaseMessage]:
+        return self.bind(**self.inner.bind_tools(tools, **kwargs).kwargs)
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return self.inner._generate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return await self.inner._agenerate(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        yield from self.inner._stream(messages, stop=stop, run_manager=run_manager, **kwargs)
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        async for chunk in self.inner._astream(messages, stop=stop, run_manager=run_manager, **kwargs):
+            yield chunk
@@ -28,7 +28,7 @@ from langgraph.checkpoint.sqlite.aio import AsyncSqliteSaver
 from langgraph.graph.state import CompiledStateGraph
 from langsmith import Client as LangsmithClient
 
-from agents import DEFAULT_AGENT, agents
+from agents import DEFAULT_AGENT, agents, summarizer
 from schema import (
     ChatHistory,
     ChatHistoryInput,
@@ -43,6 +43,8 @@ from service.utils import (
     langchain_to_chat_message,
     remove_tool_calls,
 )
+from utils import metrics
+from utils.cus_data import HOLD_TOKENS_TAG, RELEASE_TOKENS_EVENT
 
 warnings.filterwarnings("ignore", category=LangChainBetaWarning)
 logger = logging.getLogger(__name__)
@@ -66,8 +68,13 @@ async def lifespan(app: FastAPI) -> AsyncGenerator[None, None]:
     # Construct agent with Sqlite checkpointer
     # TODO: It's probably dangerous to share the same checkpointer on multiple agents
     async with AsyncSqliteSaver.from_conn_string("checkpoints.db") as saver:
-        for a in agents.values():
-            a.checkpointer = saver
+        # Agents are built on first use (see agents/graph.py), so attach the saver as they load
+        def use_saver(agent: CompiledStateGraph) -> None:
+            agent.checkpointer = saver
+
+        agents.on_load = use_saver
+        for a in agents.loaded().values():
+            use_saver(a)
         yield
     # context manager will clean up the AsyncSqliteSaver on exit
 
@@ -98,6 +105,7 @@ async def ainvoke(user_input: UserInput, agent_id: str = DEFAULT_AGENT) -> ChatM
     kwargs, run_id = _parse_input(user_input)
     try:
         response = await agent.ainvoke(**kwargs)
+        summarizer.schedule(agent, kwargs["config"])
         output = langchain_to_chat_message(response["messages"][-1])
         output.run_id = str(run_id)
         return output
@@ -138,6 +146,9 @@ async def message_generator(
     """
     agent: CompiledStateGraph = agents[agent_id]
     kwargs, run_id = _parse_input(user_input)
+    # Tokens held back until the guard releases them, as (length, SSE line)
+    held_tokens: list[tuple[int, str]] = []
+    released_chars = 0
 
     # Process streamed events from the graph and yield messages over the SSE stream.
     async for event in agent.astream_events(**kwargs, version="v2"):
@@ -159,6 +170,17 @@ async def message_generator(
         if event["event"] == "on_custom_event" and "custom_data_dispatch" in event.get("tags", []):
             new_messages = [event["data"]]
 
+        if event["event"] == "on_custom_event" and event["name"] == RELEASE_TOKENS_EVENT:
+            chars = event["data"]["chars"]
+            while held_tokens and (chars is None or released_chars + held_tokens[0][0] <= chars):
+                length, token = held_tokens.pop(0)
+                released_chars += length
+                yield token
+            if event["data"]["final"]:
+                held_tokens.clear()
+                released_chars = 0
+            continue
+
         for message in new_messages:
             try:
                 chat_message = langchain_to_chat_message(message)
@@ -183,9 +205,16 @@ async def message_generator(
                 # Empty content in the context of OpenAI usually means
                 # that the model is asking for a tool to be invoked.
                 # So we only print non-empty content.
-                yield f"data: {json.dumps({'type': 'token', 'content': convert_message_content_to_string(content)})}\n\n"
+                text = convert_message_content_to_string(content)
+                token = f"data: {json.dumps({'type': 'token', 'content': text})}\n\n"
+                if HOLD_TOKENS_TAG in event.get("tags", []):
+                    held_tokens.append((len(text), token))
+                else:
+                    yield token
             continue
 
+    # Fold old turns into the thread summary off the response path
+    summarizer.schedule(agent, kwargs["config"])
     yield "data: [DONE]\n\n"
 
 
@@ -276,4 +305,12 @@ def history(input: ChatHistoryInput) -> ChatHistory:
         raise HTTPException(status_code=500, detail="Unexpected error")
 
 
+@router.get("/metrics")
+def get_metrics() -> dict[str, dict]:
+    """
+    Get runtime stats of the service, e.g. RAG retrieval pool and cache counters.
+    """
+    return metrics.collect()
+
+
 app.include_router(router)
@@ -0,0 +1,183 @@
+"""
+Inverted-index BM25 scorer over the RAG chunk store.
+
+Embedding search misses exact clinical terms (drug names, named disorders), so
+the retriever fuses these lexical scores with vector scores.
+
+Posting lists are stored CSR style in flat .npy arrays next to the vector
+store and opened with np.memmap:
+    bm25.<version>.terms.json     sorted vocabulary; term id = position
+    bm25.<version>.offsets.npy    int64, postings of term t are [offsets[t], offsets[t + 1])
+    bm25.<version>.docs.npy       int32 row of every posting
+    bm25.<version>.tfs.npy        uint16 term frequency of every posting
+    bm25.<version>.doc_len.npy    uint32 token count of every row
+
+A query only touches the postings of its own terms, so lookups stay
+sub-millisecond as the corpus grows.
+"""
+import heapq
+import itertools
+import json
+import math
+import os
+import re
+from array import array
+from collections import Counter
+
+import numpy as np
+
+from utils.vector_store import open_npy, raw_to_npy
+
+K1 = 1.5
+B = 0.75
+# Postings buffered in memory before they are spilled to a sorted run on disk
+RUN_POSTINGS = int(os.getenv("BM25_RUN_POSTINGS", "1000000"))
+
+TOKEN_RE = re.compile(r"[a-z0-9]+(?:['-][a-z0-9]+)*")
+STOPWORDS = frozenset(
+    """
+    a about am an and are as at be been but by can do does did for from had has have
+    he her him his how i if in into is it its me my of on or our she so that the their
+    them then there these they this to too was we were what when which who why will
+    with would you your
+    """.split()
+)
+
+
+def tokenize(text: str) -> list[str]:
+    return [t for t in TOKEN_RE.findall(text.lower()) if t not in STOPWORDS]
+
+
+class BM25Writer:
+    """
+    Builds the posting lists under prefix with an external sort.
+
+    Postings are buffered per term until RUN_POSTINGS of them are held, then
+    written out as a run sorted by term; save() merges the runs term by term
+    straight into the final files. Memory is bounded by the run size, not by
+    the corpus size.
+    """
+
+    def __init__(self, prefix: str, run_postings: int = RUN_POSTINGS) -> None:
+        self.prefix = prefix
+        self.run_postings = run_postings
+        self.postings: dict[str, tuple[array, array]] = {}
+        self.buffered = 0
+        self.total = 0
+        self.runs: list[str] = []
+        self.docs = 0
+        self.doc_len = open(f"{prefix}.doc_len.u32", "wb")
+
+    def add(self, text: str) -> None:
+        tokens = tokenize(text)
+        for term, tf in Counter(tokens).items():
+            docs, tfs = self.postings.setdefault(term, (array("i"), array("H")))
+            docs.append(self.docs)
+            tfs.append(min(tf, 65535))
+        self.buffered += len(set(tokens))
+        self.doc_len.write(array("I", [len(tokens)]).tobytes())
+        self.docs += 1
+        if self.buffered >= self.run_postings:
+            self._spill()
+
+    def _spill(self) -> None:
+        """Write the buffered postings as run files: terms with counts, then docs and tfs in term order."""
+        run = f"{self.prefix}.run{len(self.runs)}"
+        with open(f"{run}.terms", "w", encoding="utf-8") as terms, open(f"{run}.docs", "wb") as docs, open(
+            f"{run}.tfs", "wb"
+        ) as tfs:
+            for term in sorted(self.postings):
+                term_docs, term_tfs = self.postings[term]
+                terms.write(f"{term}\t{len(term_docs)}\n")
+                docs.write(term_docs.tobytes())
+                tfs.write(term_tfs.tobytes())
+        self.runs.append(run)
+        self.total += self.buffered
+        self.postings = {}
+        self.buffered = 0
+
+    def save(self) -> None:
+        self.doc_len.close()
+        if self.postings:
+            self._spill()
+        runs = [
+            (open(f"{run}.terms", encoding="utf-8"), open(f"{run}.docs", "rb"), open(f"{run}.tfs", "rb"))
+            for run in self.runs
+        ]
+
+        def run_terms(i: int):
+            for line in runs[i][0]:
+                term, count = line.rstrip("\n").split("\t")
+                yield term, i, int(count)
+
+        # Runs hold consecutive rows, so appending them in run order keeps each posting list sorted
+        merged = heapq.merge(*(run_terms(i) for i in range(len(runs))))
+        terms_count = 0
+        position = 0
+        with open(f"{self.prefix}.terms.json", "w", encoding="utf-8") as terms, open(
+            f"{self.prefix}.offsets.i64", "wb"
+        ) as offsets, open_npy(
+            f"{self.prefix}.docs.npy", np.int32, self.total
+        ) as docs, open_npy(f"{self.prefix}.tfs.npy", np.uint16, self.total) as tfs:
+            terms.write("[")
+            offsets.write(array("q", [0]).tobytes())
+            for term, group in itertools.groupby(merged, key=lambda entry: entry[0]):
+                for _, i, count in group:
+                    docs.write(runs[i][1].read(4 * count))
+                    tfs.write(runs[i][2].read(2 * count))
+                    position += count
+                terms.write(("" if terms_count == 0 else ", ") + json.dumps(term, ensure_ascii=False))
+                offsets.write(array("q", [position]).tobytes())
+                terms_count += 1
+            terms.write("]")
+        for files, run in zip(runs, self.runs):
+            for f, suffix in zip(files, ["terms", "docs", "tfs"]):
+                f.close()
+                os.remove(f"{run}.{suffix}")
+        raw_to_npy(f"{self.prefix}.offsets.i64", f"{self.prefix}.offsets.npy", np.int64, terms_count + 1)
+        raw_to_npy(f"{self.prefix}.doc_len.u32", f"{self.prefix}.doc_len.npy", np.uint32, self.docs)
+
+
+class BM25Index:
+    def __init__(self, prefix: str, deleted: list[int] = []) -> None:
+        with open(f"{prefix}.terms.json", encoding="utf-8") as f:
+            self.term_ids = {term: i for i, term in enumerate(json.load(f))}
+        self.offsets = np.load(f"{prefix}.offsets.npy", mmap_mode="r")
+        self.docs = np.load(f"{prefix}.docs.npy", mmap_mode="r")
+        self.tfs = np.load(f"{prefix}.tfs.npy", mmap_mode="r")
+        self.doc_len = np.load(f"{prefix}.doc_len.npy").astype(np.float32)
+        self.deleted = np.asarray(deleted, dtype=np.int64)
+        self.count = len(self.doc_len) - len(set(deleted))
+        self.avg_len = float(self.doc_len.mean()) if len(self.doc_len) else 0.0
+        # Rough size of the vocabulary dict plus the posting arrays
+        self.nbytes = 100 * len(self.term_ids) + sum(
+            a.nbytes for a in [self.offsets, self.docs, self.tfs, self.doc_len]
+        )
+
+    def search(self, query: str, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Return (rows, scores) of the k best BM25 matches, best first."""
+        docs, scores = [], []
+        for term in set(tokenize(query)):
+            term_id = self.term_ids.get(term)
+            if term_id is None:
+                continue
+            start, end = self.offsets[term_id], self.offsets[term_id + 1]
+            term_docs = np.asarray(self.docs[start:end])
+            tfs = np.asarray(self.tfs[start:end], dtype=np.float32)
+            idf = math.log(1 + (self.count - len(term_docs) + 0.5) / (len(term_docs) + 0.5))
+            norm = K1 * (1 - B + B * self.doc_len[term_docs] / self.avg_len)
+            docs.append(term_docs)
+            scores.append(idf * tfs * (K1 + 1) / (tfs + norm))
+        if not docs:
+            return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.float32)
+
+        rows, inverse = np.unique(np.concatenate(docs), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate(scores))
+        if len(self.deleted):
+            keep = ~np.isin(rows, self.deleted)
+            rows, totals = rows[keep], totals[keep]
+        if k < len(rows):
+            top = np.argpartition(totals, -k)[-k:]
+            rows, totals = rows[top], totals[top]
+        order = np.argsort(-totals)
+        return rows[order].astype(np.int64), totals[order].astype(np.float32)
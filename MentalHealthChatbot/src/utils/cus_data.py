@@ -6,6 +6,11 @@ from langchain_core.runnables import RunnableConfig
 from langchain_core.runnables.config import merge_configs
 from pydantic import BaseModel, Field
 
+# Tokens streamed by chat model runs tagged HOLD_TOKENS_TAG are held back by the
+# service until the graph dispatches RELEASE_TOKENS_EVENT (see release_tokens)
+HOLD_TOKENS_TAG = "hold_tokens"
+RELEASE_TOKENS_EVENT = "release_tokens"
+
 
 class CustomData(BaseModel):
     "Custom data being sent by an agent"
@@ -28,3 +33,14 @@ class CustomData(BaseModel):
             data=self.to_langchain(),
             config=merge_configs(config, dispatch_config),
         )
+
+
+async def release_tokens(config: RunnableConfig, chars: int | None = None, final: bool = True) -> None:
+    """
+    Let the service send the held tokens of the current response up to its
+    first `chars` characters (all of them if None). A final release drops
+    whatever is still held and starts afresh for the next response.
+    """
+    await adispatch_custom_event(
+        name=RELEASE_TOKENS_EVENT, data={"chars": chars, "final": final}, config=config
+    )
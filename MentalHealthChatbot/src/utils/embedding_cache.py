@@ -0,0 +1,112 @@
+"""
+Persistent embedding cache shared by everything that embeds text: RAG
+ingestion, query embedding and, through the query embedding, the semantic
+answer cache.
+
+Vectors are stored in SQLite (EMBEDDING_CACHE_PATH) keyed by
+(model, sha256(text)), looked up and written in batches. Re-indexing unchanged
+chunks or re-asking an identical question costs no embedding call.
+"""
+import hashlib
+import os
+import sqlite3
+import threading
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_openai import OpenAIEmbeddings
+
+from utils import metrics
+
+# SQLite limits the number of bound parameters per statement
+BATCH_SIZE = 500
+
+counters = {"hits": 0, "misses": 0}
+_counters_lock = threading.Lock()
+
+
+def get_cache_path() -> str:
+    return os.getenv("EMBEDDING_CACHE_PATH", "embeddings_cache.db")
+
+
+def text_key(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingStore:
+    """SQLite table of float32 vectors; one connection per thread."""
+
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                """CREATE TABLE IF NOT EXISTS embeddings
+                   (model TEXT, key TEXT, vector BLOB, PRIMARY KEY (model, key)) WITHOUT ROWID"""
+            )
+            self._local.conn = conn
+        return conn
+
+    def get_many(self, model: str, keys: list[str]) -> dict[str, np.ndarray]:
+        found = {}
+        for start in range(0, len(keys), BATCH_SIZE):
+            batch = keys[start : start + BATCH_SIZE]
+            rows = self.conn.execute(
+                f"SELECT key, vector FROM embeddings WHERE model = ? AND key IN ({','.join('?' * len(batch))})",
+                [model, *batch],
+            )
+            for key, vector in rows:
+                found[key] = np.frombuffer(vector, dtype=np.float32)
+        return found
+
+    def put_many(self, model: str, items: dict[str, np.ndarray]) -> None:
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO embeddings (model, key, vector) VALUES (?, ?, ?)",
+                [(model, key, np.asarray(v, dtype=np.float32).tobytes()) for key, v in items.items()],
+            )
+
+
+_stores: dict[str, EmbeddingStore] = {}
+
+
+class CachedEmbeddings(Embeddings):
+    """OpenAIEmbeddings behind the persistent cache."""
+
+    def __init__(self, model: str) -> None:
+        self.model = model
+        self.embedder = OpenAIEmbeddings(model=model)
+        path = get_cache_path()
+        self.store = _stores.setdefault(path, EmbeddingStore(path))
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        keys = [text_key(t) for t in texts]
+        found = self.store.get_many(self.model, list(set(keys)))
+        missing = {key: text for key, text in zip(keys, texts) if key not in found}
+        misses = sum(key in missing for key in keys)
+        with _counters_lock:
+            counters["hits"] += len(keys) - misses
+            counters["misses"] += misses
+        if missing:
+            vectors = self.embedder.embed_documents(list(missing.values()))
+            new = {key: np.asarray(v, dtype=np.float32) for key, v in zip(missing, vectors)}
+            self.store.put_many(self.model, new)
+            found.update(new)
+        return [found[key].tolist() for key in keys]
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.embed_documents([text])[0]
+
+
+def stats() -> dict:
+    lookups = counters["hits"] + counters["misses"]
+    return {**counters, "hit_rate": counters["hits"] / lookups if lookups else 0.0}
+
+
+metrics.register("embedding_cache", stats)
@@ -0,0 +1,51 @@
+"""
+Report the import cost of each module at service startup.
+
+Runs `python -X importtime -c "import <module>"` in a fresh interpreter and
+lists the slowest modules by cumulative time, i.e. including everything they
+import. With --budget it exits non-zero when the total import time of the
+module is over budget, so it can guard cold start in CI.
+
+    $ cd src; poetry run python -m utils.import_profile service --top 25 --budget 1.5
+"""
+import argparse
+import re
+import subprocess
+import sys
+
+LINE_RE = re.compile(r"import time:\s+(\d+) \|\s+(\d+) \| (\s*)(\S+)")
+
+
+def profile(module: str) -> list[tuple[str, int, float, float]]:
+    """Return (module, depth, self seconds, cumulative seconds) for every import."""
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"import {module} failed:\n{result.stderr[-2000:]}")
+    rows = []
+    for line in result.stderr.splitlines():
+        if match := LINE_RE.match(line):
+            self_us, cumulative_us, indent, name = match.groups()
+            rows.append((name, len(indent) // 2, int(self_us) / 1e6, int(cumulative_us) / 1e6))
+    return rows
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Profile the import time of a module.")
+    parser.add_argument("module", nargs="?", default="service")
+    parser.add_argument("--top", type=int, default=20)
+    parser.add_argument("--budget", type=float, help="fail if the total is over this many seconds")
+    args = parser.parse_args()
+
+    rows = profile(args.module)
+    total = next(cumulative for name, _, _, cumulative in rows if name == args.module)
+    print(f"{'cumulative':>10} {'self':>8}  module")
+    for name, depth, self_s, cumulative in sorted(rows, key=lambda r: -r[3])[: args.top]:
+        print(f"{cumulative:9.3f}s {self_s:7.3f}s  {name}")
+    print(f"total import time of {args.module}: {total:.3f}s")
+    if args.budget is not None and total > args.budget:
+        print(f"over the budget of {args.budget:.3f}s")
+        sys.exit(1)
@@ -0,0 +1,73 @@
+"""
+Registry of loaded RAG indexes, one per tenant (patient or clinic) plus the
+global knowledge base.
+
+Indexes are loaded lazily on first use and reloaded when their manifest
+changes. Only the `max_loaded` most recently used indexes stay loaded, within
+a total budget of `max_bytes`; colder ones are dropped and fall back to their
+on-disk form until they are asked for again.
+"""
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable
+
+
+class IndexRegistry:
+    """`load(index_dir)` must return an object with an `nbytes` attribute."""
+
+    def __init__(
+        self,
+        load: Callable[[str], Any],
+        manifest: str,
+        max_loaded: int = 32,
+        max_bytes: int = 2 << 30,
+    ) -> None:
+        self.load = load
+        self.manifest = manifest
+        self.max_loaded = max_loaded
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.loads = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._loaded: OrderedDict[str, tuple[int, Any]] = OrderedDict()
+
+    def get(self, index_dir: str) -> Any:
+        mtime = os.stat(os.path.join(index_dir, self.manifest)).st_mtime_ns
+        with self._lock:
+            cached = self._loaded.get(index_dir)
+            if cached is not None and cached[0] == mtime:
+                self._loaded.move_to_end(index_dir)
+                self.hits += 1
+                return cached[1]
+        index = self.load(index_dir)
+        with self._lock:
+            self.loads += 1
+            self._loaded[index_dir] = (mtime, index)
+            self._loaded.move_to_end(index_dir)
+            self._evict()
+        return index
+
+    def _evict(self) -> None:
+        # The most recently used index is always kept, even if it alone is over budget.
+        while len(self._loaded) > 1 and (
+            len(self._loaded) > self.max_loaded or self.nbytes > self.max_bytes
+        ):
+            self._loaded.popitem(last=False)
+            self.evictions += 1
+
+    @property
+    def nbytes(self) -> int:
+        return sum(index.nbytes for _, index in self._loaded.values())
+
+    def stats(self) -> dict:
+        return {
+            "loaded": len(self._loaded),
+            "max_loaded": self.max_loaded,
+            "bytes": self.nbytes,
+            "max_bytes": self.max_bytes,
+            "hits": self.hits,
+            "loads": self.loads,
+            "evictions": self.evictions,
+        }
@@ -0,0 +1,265 @@
+"""
+Streaming, bounded-memory ingestion of documents into the RAG index.
+
+Documents flow through a generator pipeline instead of being loaded at once:
+
+    read/parse thread -> chunk thread -> embed (process pool) -> IndexWriter
+
+Parsing yields one PDF page or one text block at a time, every hand-off is a
+bounded queue, at most EMBED_WORKERS * 2 embedding batches are in flight, and
+IndexWriter appends rows straight to disk: chunk records, byte offsets and
+vectors go to files as they arrive, and BM25 postings are spilled in sorted
+runs of BM25_RUN_POSTINGS (see utils/bm25.py). The pipeline's memory therefore
+depends on those sizes, not on the size of the corpus.
+
+What does grow with the corpus is the manifest: utils/rag.py keeps the row ids
+of every indexed file, and the tombstones, in manifest.json and loads it whole.
+Ingestion itself only tracks one row range per file.
+"""
+import json
+import multiprocessing
+import os
+import queue
+import threading
+import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterator
+
+import numpy as np
+from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from utils import embedding_cache
+from utils.bm25 import BM25Writer
+from utils.vector_store import normalize, raw_to_npy
+
+CHUNK_SIZE = 1000
+CHUNK_OVERLAP = 200
+# Plain-text files are parsed in blocks of roughly this many characters
+TEXT_BLOCK_SIZE = 64 * 1024
+EMBED_BATCH = int(os.getenv("RAG_EMBED_BATCH", "256"))
+EMBED_WORKERS = int(os.getenv("RAG_EMBED_WORKERS", "2"))
+QUEUE_SIZE = 8
+# Rows copied per block when carrying an old index version over
+COPY_BLOCK = 10_000
+
+_DONE = object()
+
+
+def iter_segments(path: str) -> Iterator[str]:
+    """Yield a document one PDF page or one block of text lines at a time."""
+    if path.lower().endswith(".pdf"):
+        from pypdf import PdfReader
+
+        for page in PdfReader(path).pages:
+            yield page.extract_text() or ""
+        return
+    with open(path, encoding="utf-8", errors="ignore") as f:
+        block = []
+        size = 0
+        for line in f:
+            block.append(line)
+            size += len(line)
+            if size >= TEXT_BLOCK_SIZE:
+                yield "".join(block)
+                block, size = [], 0
+        if block:
+            yield "".join(block)
+
+
+_embedders: dict[str, embedding_cache.CachedEmbeddings] = {}
+
+
+def embed_batch(model: str, texts: list[str]) -> tuple[np.ndarray, int]:
+    """
+    Embed one batch of texts; runs in the worker processes. Returns the
+    vectors and how many of them came from the embedding cache.
+    """
+    if model not in _embedders:
+        _embedders[model] = embedding_cache.CachedEmbeddings(model)
+    hits = embedding_cache.counters["hits"]
+    vectors = normalize(_embedders[model].embed_documents(texts))
+    return vectors, embedding_cache.counters["hits"] - hits
+
+
+class IndexWriter:
+    """
+    Append-only writer for one version of the index.
+
+    Rows are written to disk as they arrive: chunk metadata to the JSON-lines
+    side table, its byte offsets and the vectors to raw files, which `finish`
+    turns into .npy files block by block.
+    """
+
+    def __init__(self, index_dir: str, version: int) -> None:
+        self.index_dir = index_dir
+        self.files = {
+            "chunks_file": f"chunks.{version}.jsonl",
+            "offsets_file": f"offsets.{version}.npy",
+            "embeddings_file": f"embeddings.{version}.npy",
+            "bm25_prefix": f"bm25.{version}",
+        }
+        os.makedirs(index_dir, exist_ok=True)
+        self.chunks = open(self._path("chunks_file"), "wb")
+        self.raw_path = self._path("embeddings_file") + ".f32"
+        self.raw = open(self.raw_path, "wb")
+        self.offsets_path = self._path("offsets_file") + ".i64"
+        self.offsets = open(self.offsets_path, "wb")
+        self.bm25 = BM25Writer(os.path.join(index_dir, self.files["bm25_prefix"]))
+        self.count = 0
+        self.dim = 0
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.index_dir, self.files[key])
+
+    def append(self, chunks: list[dict], vectors: np.ndarray) -> range:
+        """Append rows and return their row ids."""
+        if len(chunks) == 0:
+            return range(self.count, self.count)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        self.dim = vectors.shape[1]
+        offsets = array("q")
+        for chunk in chunks:
+            offsets.append(self.chunks.tell())
+            self.chunks.write(json.dumps(chunk, ensure_ascii=False).encode("utf-8") + b"\n")
+            self.bm25.add(chunk["text"])
+        self.offsets.write(offsets.tobytes())
+        self.raw.write(vectors.tobytes())
+        rows = range(self.count, self.count + len(chunks))
+        self.count += len(chunks)
+        return rows
+
+    def finish(self) -> dict:
+        """Flush everything to the final files and return their names for the manifest."""
+        self.chunks.close()
+        self.raw.close()
+        self.offsets.close()
+        raw_to_npy(self.offsets_path, self._path("offsets_file"), np.int64, self.count)
+        self.bm25.save()
+        if self.count == 0:
+            np.save(self._path("embeddings_file"), np.zeros((0, self.dim), dtype=np.float32))
+            os.remove(self.raw_path)
+            return {**self.files, "count": 0, "dim": self.dim}
+        raw = np.memmap(self.raw_path, dtype=np.float32, mode="r", shape=(self.count * self.dim,))
+        matrix = np.lib.format.open_memmap(
+            self._path("embeddings_file"), mode="w+", dtype=np.float32, shape=(self.count, self.dim)
+        )
+        for start in range(0, self.count, COPY_BLOCK):
+            end = min(start + COPY_BLOCK, self.count)
+            matrix[start:end] = raw[start * self.dim : end * self.dim].reshape(-1, self.dim)
+        matrix.flush()
+        del matrix, raw
+        os.remove(self.raw_path)
+        return {**self.files, "count": self.count, "dim": self.dim}
+
+
+def _drain(q: queue.Queue) -> Iterator:
+    while (item := q.get()) is not _DONE:
+        yield item
+
+
+class _Stage(threading.Thread):
+    """
+    Runs `produce(put)` on its own thread and always ends its output queue
+    with _DONE. On failure it keeps draining its input so upstream stages
+    blocked on a full queue can finish.
+    """
+
+    def __init__(self, produce, output: queue.Queue, input: queue.Queue | None = None) -> None:
+        super().__init__(daemon=True)
+        self.produce = produce
+        self.output = output
+        self.input = input
+        self.error = None
+
+    def run(self) -> None:
+        try:
+            self.produce(self.output.put)
+        except BaseException as e:
+            self.error = e
+            if self.input is not None:
+                for _ in _drain(self.input):
+                    pass
+        finally:
+            self.output.put(_DONE)
+
+
+def ingest(files: list[tuple[str, str]], writer: IndexWriter, model: str) -> dict:
+    """
+    Chunk, embed and append every (source, path) in files to writer.
+
+    Returns the rows written for each source, as a range since a source's
+    chunks are written back to back, plus throughput stats.
+    """
+    started_at = time.perf_counter()
+    splitter = RecursiveCharacterTextSplitter(chunk_size=CHUNK_SIZE, chunk_overlap=CHUNK_OVERLAP)
+    segments: queue.Queue = queue.Queue(QUEUE_SIZE)
+    batches: queue.Queue = queue.Queue(QUEUE_SIZE)
+
+    def parse(put) -> None:
+        for source, path in files:
+            for segment in iter_segments(path):
+                put((source, segment))
+
+    def chunk(put) -> None:
+        batch = []
+        for source, segment in _drain(segments):
+            for text in splitter.split_text(segment):
+                batch.append({"source": source, "text": text})
+                if len(batch) >= EMBED_BATCH:
+                    put(batch)
+                    batch = []
+        if batch:
+            put(batch)
+
+    stages = [_Stage(parse, segments), _Stage(chunk, batches, segments)]
+    for stage in stages:
+        stage.start()
+
+    # First and end row of every source
+    spans: dict[str, list[int]] = {}
+    pending: deque = deque()
+    cache_hits = 0
+
+    def write_oldest() -> None:
+        nonlocal cache_hits
+        batch, future = pending.popleft()
+        vectors, hits = future.result()
+        cache_hits += hits
+        for row, c in zip(writer.append(batch, vectors), batch):
+            span = spans.setdefault(c["source"], [row, row])
+            span[1] = row + 1
+
+    # spawn, not fork: the pipeline threads are already running.
+    context = multiprocessing.get_context("spawn")
+    drained = False
+    try:
+        with ProcessPoolExecutor(max_workers=EMBED_WORKERS, mp_context=context) as pool:
+            for batch in _drain(batches):
+                pending.append((batch, pool.submit(embed_batch, model, [c["text"] for c in batch])))
+                if len(pending) >= EMBED_WORKERS * 2:
+                    write_oldest()
+            drained = True
+            while pending:
+                write_oldest()
+    finally:
+        if not drained:
+            for _ in _drain(batches):
+                pass
+        for stage in stages:
+            stage.join()
+    for stage in stages:
+        if stage.error is not None:
+            raise stage.error
+
+    seconds = time.perf_counter() - started_at
+    rows = {source: range(*spans.get(source, (0, 0))) for source, _ in files}
+    chunks = sum(len(r) for r in rows.values())
+    return {
+        "rows": rows,
+        "chunks": chunks,
+        "seconds": seconds,
+        "chunks_per_second": chunks / seconds if seconds else 0.0,
+        "embedding_cache_hits": cache_hits,
+    }
@@ -0,0 +1,61 @@
+"""
+Mapping whose values are built on first access.
+
+Used for the chat models and agent graphs, so importing `agents` does not
+import every provider SDK and tool or compile every graph before the server
+can bind its port. Keys are known up front; values are built once by their
+factory, under a lock, and the build time is recorded for /metrics.
+"""
+import threading
+import time
+from collections.abc import Mapping
+from typing import Callable, Generic, Iterator, TypeVar
+
+V = TypeVar("V")
+
+
+class LazyMapping(Mapping[str, V], Generic[V]):
+    def __init__(self, factories: dict[str, Callable[[], V]] | None = None) -> None:
+        self.factories: dict[str, Callable[[], V]] = dict(factories or {})
+        # Called with every value once it is built, e.g. to attach a checkpointer
+        self.on_load: Callable[[V], None] | None = None
+        self.load_seconds: dict[str, float] = {}
+        self._values: dict[str, V] = {}
+        self._lock = threading.RLock()
+
+    def register(self, key: str, factory: Callable[[], V]) -> None:
+        self.factories[key] = factory
+
+    def __getitem__(self, key: str) -> V:
+        if key in self._values:
+            return self._values[key]
+        factory = self.factories[key]
+        with self._lock:
+            if key not in self._values:
+                started_at = time.perf_counter()
+                value = factory()
+                if self.on_load is not None:
+                    self.on_load(value)
+                self._values[key] = value
+                self.load_seconds[key] = time.perf_counter() - started_at
+            return self._values[key]
+
+    def __contains__(self, key: object) -> bool:
+        return key in self.factories
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.factories)
+
+    def __len__(self) -> int:
+        return len(self.factories)
+
+    def loaded(self) -> dict[str, V]:
+        """The values built so far, without building the rest."""
+        return dict(self._values)
+
+    def stats(self) -> dict:
+        return {
+            "registered": len(self.factories),
+            "loaded": len(self._values),
+            "load_seconds": {key: round(s, 3) for key, s in self.load_seconds.items()},
+        }
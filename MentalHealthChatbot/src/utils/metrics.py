@@ -0,0 +1,17 @@
+"""
+Process-wide registry of runtime stats, served by GET /metrics.
+
+Subsystems register a zero-argument callable returning a dict of counters and
+gauges; it is only called when the endpoint is scraped.
+"""
+from typing import Callable
+
+_collectors: dict[str, Callable[[], dict]] = {}
+
+
+def register(name: str, collector: Callable[[], dict]) -> None:
+    _collectors[name] = collector
+
+
+def collect() -> dict[str, dict]:
+    return {name: collector() for name, collector in _collectors.items()}
@@ -1,27 +1,484 @@
+"""
+RAG over the mental health knowledge base in RAG_DATA_DIR.
+
+The corpus is parsed, chunked and embedded by the `build` command and written
+to RAG_INDEX_DIR. The psychologist node only loads that index and queries it,
+so per-question latency no longer depends on the size of the corpus.
+
+    $ cd src; poetry run python -m utils.rag build
+    $ cd src; poetry run python -m utils.rag compact
+    $ cd src; poetry run python -m utils.rag ask "How do I cope with work stress?"
+
+`build` streams documents through the bounded-memory pipeline in
+utils/ingest.py and is incremental: manifest.json records the mtime, size and
+sha256 of every indexed file, and only added or changed files are re-chunked
+and re-embedded. Rows of changed or deleted files are tombstoned rather than
+rewritten, and are dropped by `compact` (run automatically once tombstones
+pass COMPACT_RATIO of the index).
+
+Index layout:
+    manifest.json            version, embedding model, files, tombstones
+    chunks.<version>.jsonl   one {"source", "text"} record per row
+    offsets.<version>.npy    byte offset of every row in chunks.<version>.jsonl
+    embeddings.<version>.npy float32 (count, dim) matrix of L2-normalized rows
+    bm25.<version>.*         inverted index over the same rows (see utils/bm25.py)
+
+Queries go through utils.vector_store.VectorStore, which memory-maps the
+embeddings so worker processes share them through the page cache, and through
+utils.bm25.BM25Index for exact terms; the two rankings are merged with
+reciprocal rank fusion.
+
+Every update writes a new version and switches to it by replacing
+manifest.json, so running retrievers keep serving the old version until they
+pick up the new one.
+
+All embeddings go through utils.embedding_cache, so unchanged chunks and
+repeated questions are never embedded twice.
+
+Answers are served from utils.semantic_cache.SemanticCache when a sufficiently
+similar question was already answered from the same index version.
+
+Each tenant (patient or clinic, keyed by user_id) may have its own knowledge
+base in RAG_DATA_DIR/users/<user_id>, indexed into RAG_INDEX_DIR/users/<user_id>
+with `build --user <user_id>`; tenants without one use the global index.
+Loaded indexes are kept in a utils.index_registry.IndexRegistry bounded by
+RAG_MAX_LOADED_INDEXES and RAG_INDEX_MEMORY_BUDGET.
+
+`get_brain` is a coroutine: embedding, cache lookup and search run on the
+RetrievalPool worker threads, at most RAG_MAX_IN_FLIGHT at a time, so a slow
+query never blocks the event loop that streams tokens to other users.
+"""
+import argparse
+import asyncio
+import glob
+import hashlib
+import json
 import os
-from quivr_core import Brain
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
 from dotenv import load_dotenv
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import HumanMessage, SystemMessage
+from langchain_core.runnables import RunnableConfig
+
+from utils import metrics
+from utils.bm25 import BM25Index
+from utils.embedding_cache import CachedEmbeddings
+from utils.index_registry import IndexRegistry
+from utils.ingest import COPY_BLOCK, IndexWriter, ingest
+from utils.semantic_cache import SemanticCache
+from utils.vector_store import VectorStore, normalize
+
+TOP_K = 4
+# Each ranking contributes this many candidates per requested result to the fusion
+CANDIDATES = 5
+# Standard reciprocal rank fusion constant, dampens the weight of the top ranks
+RRF_K = 60
+COMPACT_RATIO = 0.25
+MANIFEST = "manifest.json"
+
+rag_instructions = """
+Answer the patient's question using the mental health knowledge below.
+If the knowledge does not cover the question, answer from general professional knowledge.
+
+<BEGIN KNOWLEDGE>
+{context}
+<END KNOWLEDGE>
+"""
+
+
+def get_data_dir() -> str:
+    return os.getenv("RAG_DATA_DIR")
+
+
+def get_index_dir() -> str:
+    return os.getenv("RAG_INDEX_DIR", "rag_index")
 
 
-def get_brain(question: str):
-    data_dir = os.getenv("RAG_DATA_DIR")
-    file_paths = [
+def tenant_dir(base_dir: str, user_id: str) -> str:
+    """Directory of a tenant's knowledge base or index under base_dir."""
+    if not re.fullmatch(r"[\w-][\w.-]*", user_id):
+        # Keep arbitrary ids from escaping base_dir.
+        user_id = hashlib.sha256(user_id.encode("utf-8")).hexdigest()[:32]
+    return os.path.join(base_dir, "users", user_id)
+
+
+def get_embedding_model() -> str:
+    return os.getenv("RAG_EMBEDDING_MODEL", "text-embedding-3-small")
+
+
+def list_documents(data_dir: str) -> list[str]:
+    return sorted(
         os.path.join(data_dir, file)
         for file in os.listdir(data_dir)
         if os.path.isfile(os.path.join(data_dir, file))
-    ]
+    )
+
+
+def file_digest(path: str) -> str:
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def load_manifest(index_dir: str) -> dict | None:
+    path = os.path.join(index_dir, MANIFEST)
+    if not os.path.exists(path):
+        return None
+    with open(path, encoding="utf-8") as f:
+        return json.load(f)
+
+
+def empty_manifest() -> dict:
+    return {
+        "version": 0,
+        "embedding_model": get_embedding_model(),
+        "dim": 0,
+        "count": 0,
+        "files": {},
+        "deleted": [],
+    }
+
+
+def save_manifest(index_dir: str, manifest: dict) -> None:
+    path = os.path.join(index_dir, MANIFEST)
+    with open(f"{path}.tmp", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False)
+    os.replace(f"{path}.tmp", path)
+
+
+def publish(index_dir: str, manifest: dict) -> None:
+    """Switch readers to the version described by manifest and drop older versions."""
+    save_manifest(index_dir, manifest)
+    # Keep the previous version for readers that are still switching over.
+    for pattern in ["chunks.*.jsonl", "offsets.*.npy", "embeddings.*.npy*", "bm25.*.*"]:
+        for path in glob.glob(os.path.join(index_dir, pattern)):
+            if int(os.path.basename(path).split(".")[1]) < manifest["version"] - 1:
+                os.remove(path)
+
+
+def carry_over(index_dir: str, manifest: dict, writer: IndexWriter, compacting: bool) -> None:
+    """
+    Copy the rows of the current version into writer block by block. When
+    compacting, tombstoned rows are dropped and the manifest rows renumbered.
+    """
+    if "chunks_file" not in manifest:
+        return
+    count = manifest["count"]
+    embeddings = np.load(os.path.join(index_dir, manifest["embeddings_file"]), mmap_mode="r")
+    keep = np.ones(count, dtype=bool)
+    if compacting:
+        keep[manifest["deleted"]] = False
+    new_rows = np.full(count, -1, dtype=np.int64)
+    with open(os.path.join(index_dir, manifest["chunks_file"]), "rb") as f:
+        for start in range(0, count, COPY_BLOCK):
+            end = min(start + COPY_BLOCK, count)
+            block_keep = keep[start:end]
+            lines = [f.readline() for _ in range(start, end)]
+            chunks = [json.loads(line) for line, k in zip(lines, block_keep) if k]
+            rows = writer.append(chunks, embeddings[start:end][block_keep])
+            new_rows[start:end][block_keep] = rows
+    for entry in manifest["files"].values():
+        entry["rows"] = new_rows[entry["rows"]].tolist()
+    manifest["deleted"] = [] if compacting else new_rows[manifest["deleted"]].tolist()
 
-    brain = Brain.from_files(
-        name="test_brain",
-        file_paths=file_paths,
+
+def update_index(data_dir: str, index_dir: str, full: bool = False, force_compact: bool = False) -> dict:
+    """
+    Bring the index in index_dir up to date with the documents in data_dir.
+
+    Only files whose size, mtime or content hash changed since the last update
+    are re-chunked and re-embedded, through the streaming pipeline in
+    utils/ingest.py. Returns counts of what was done and ingestion throughput.
+    """
+    manifest = load_manifest(index_dir)
+    if manifest is None or full or manifest["embedding_model"] != get_embedding_model():
+        # Start from scratch, but keep versions increasing for running readers.
+        version = manifest["version"] if manifest else 0
+        manifest = empty_manifest()
+        manifest["version"] = version
+
+    stats = {"added": 0, "changed": 0, "deleted": 0, "unchanged": 0}
+    files = manifest["files"]
+    current = {os.path.relpath(path, data_dir): path for path in list_documents(data_dir)}
+    pending = []
+    for source, path in current.items():
+        stat = os.stat(path)
+        entry = files.get(source)
+        if entry and entry["mtime"] == stat.st_mtime and entry["size"] == stat.st_size:
+            stats["unchanged"] += 1
+            continue
+        digest = file_digest(path)
+        if entry and entry["sha256"] == digest:
+            entry.update(mtime=stat.st_mtime, size=stat.st_size)
+            stats["unchanged"] += 1
+            continue
+        stats["changed" if entry else "added"] += 1
+        if entry:
+            manifest["deleted"].extend(entry["rows"])
+        files[source] = {"mtime": stat.st_mtime, "size": stat.st_size, "sha256": digest, "rows": []}
+        pending.append((source, path))
+    for source in set(files) - set(current):
+        manifest["deleted"].extend(files.pop(source)["rows"])
+        stats["deleted"] += 1
+
+    if not pending and not stats["deleted"] and not force_compact:
+        stats["chunks"] = manifest["count"] - len(manifest["deleted"])
+        if "chunks_file" in manifest:
+            # At most mtimes moved; record them so the next run skips hashing.
+            save_manifest(index_dir, manifest)
+        return stats
+
+    compacting = force_compact or len(manifest["deleted"]) > COMPACT_RATIO * max(manifest["count"], 1)
+    version = manifest["version"] + 1
+    writer = IndexWriter(index_dir, version)
+    carry_over(index_dir, manifest, writer, compacting)
+    ingested = ingest(pending, writer, manifest["embedding_model"])
+    for source, rows in ingested["rows"].items():
+        files[source]["rows"] = list(rows)
+    manifest.update(writer.finish(), version=version)
+    publish(index_dir, manifest)
+
+    stats["chunks"] = manifest["count"] - len(manifest["deleted"])
+    stats["ingested_chunks"] = ingested["chunks"]
+    stats["chunks_per_second"] = round(ingested["chunks_per_second"], 1)
+    stats["embedding_cache_hits"] = ingested["embedding_cache_hits"]
+    return stats
+
+
+class Retriever:
+    """Read-only view of one version of an index written by `update_index`."""
+
+    def __init__(self, index_dir: str) -> None:
+        self.index_dir = index_dir
+        self.manifest = load_manifest(index_dir)
+        self.version = self.manifest["version"]
+        self.store = VectorStore(
+            os.path.join(index_dir, self.manifest["embeddings_file"]),
+            os.path.join(index_dir, self.manifest["chunks_file"]),
+            os.path.join(index_dir, self.manifest["offsets_file"]),
+            self.manifest["deleted"],
+        )
+        self.bm25 = BM25Index(
+            os.path.join(index_dir, self.manifest["bm25_prefix"]), self.manifest["deleted"]
+        )
+        self.embedder = CachedEmbeddings(self.manifest["embedding_model"])
+        self.nbytes = (
+            self.store.embeddings.nbytes
+            + self.store.offsets.nbytes
+            + self.bm25.nbytes
+            + sum(len(s) for s in self.manifest["files"]) * 2
+        )
+
+    def embed(self, questions: list[str]) -> np.ndarray:
+        return normalize(self.embedder.embed_documents(questions))
+
+    def search(self, question: str, k: int = TOP_K) -> list[dict]:
+        return self.search_batch([question], k)[0]
+
+    def search_batch(
+        self, questions: list[str], k: int = TOP_K, queries: np.ndarray | None = None
+    ) -> list[list[dict]]:
+        if not len(self.store):
+            return [[] for _ in questions]
+        if queries is None:
+            queries = self.embed(questions)
+        vector_rows, _ = self.store.search(queries, k * CANDIDATES)
+        results = []
+        for question, rows in zip(questions, vector_rows):
+            lexical_rows, _ = self.bm25.search(question, k * CANDIDATES)
+            fused = reciprocal_rank_fusion([rows, lexical_rows])[:k]
+            results.append([{**self.store.get(row), "score": score} for row, score in fused])
+        return results
+
+
+def reciprocal_rank_fusion(rankings: list[np.ndarray]) -> list[tuple[int, float]]:
+    """Merge rankings of row ids (best first) into one, scoring each row by sum(1 / (RRF_K + rank))."""
+    scores: dict[int, float] = {}
+    for ranking in rankings:
+        for rank, row in enumerate(ranking.tolist(), start=1):
+            scores[row] = scores.get(row, 0.0) + 1.0 / (RRF_K + rank)
+    return sorted(scores.items(), key=lambda item: item[1], reverse=True)
+
+
+registry = IndexRegistry(
+    Retriever,
+    MANIFEST,
+    max_loaded=int(os.getenv("RAG_MAX_LOADED_INDEXES", "32")),
+    max_bytes=int(os.getenv("RAG_INDEX_MEMORY_BUDGET", str(2 << 30))),
+)
+
+
+def get_retriever(user_id: str | None = None) -> Retriever:
+    """
+    Return the retriever of the user's own knowledge base, or of the global one
+    if the user has none. Indexes are loaded on first use and reloaded whenever
+    `update_index` has published a new version.
+    """
+    index_dir = os.path.abspath(get_index_dir())
+    if user_id:
+        user_index_dir = tenant_dir(index_dir, user_id)
+        if os.path.exists(os.path.join(user_index_dir, MANIFEST)):
+            index_dir = user_index_dir
+    return registry.get(index_dir)
+
+
+def format_context(chunks: list[dict]) -> str:
+    return "\n\n".join(f"[{c['source']}]\n{c['text']}" for c in chunks)
+
+
+answer_cache = SemanticCache(
+    threshold=float(os.getenv("RAG_CACHE_THRESHOLD", "0.95")),
+    max_bytes=int(os.getenv("RAG_CACHE_MAX_BYTES", str(16 << 20))),
+    ttl=float(os.getenv("RAG_CACHE_TTL", "3600")),
+)
+
+
+class RetrievalPool:
+    """Runs blocking retrieval work on worker threads with a cap on in-flight jobs."""
+
+    def __init__(self, workers: int, max_in_flight: int) -> None:
+        self.workers = workers
+        self.max_in_flight = max_in_flight
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="rag")
+        self.semaphore = asyncio.Semaphore(max_in_flight)
+        self.in_flight = 0
+        self.waiting = 0
+        self.completed = 0
+        self.failed = 0
+        self.wait_seconds = 0.0
+        self.run_seconds = 0.0
+
+    async def run(self, fn, *args):
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self.semaphore.acquire()
+        finally:
+            self.waiting -= 1
+        started_at = time.perf_counter()
+        self.wait_seconds += started_at - queued_at
+        self.in_flight += 1
+        try:
+            result = await asyncio.get_running_loop().run_in_executor(self.executor, fn, *args)
+            self.completed += 1
+            return result
+        except BaseException:
+            self.failed += 1
+            raise
+        finally:
+            self.in_flight -= 1
+            self.run_seconds += time.perf_counter() - started_at
+            self.semaphore.release()
+
+    def stats(self) -> dict:
+        finished = self.completed + self.failed
+        return {
+            "workers": self.workers,
+            "max_in_flight": self.max_in_flight,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "completed": self.completed,
+            "failed": self.failed,
+            "avg_wait_ms": 1000 * self.wait_seconds / finished if finished else 0.0,
+            "avg_run_ms": 1000 * self.run_seconds / finished if finished else 0.0,
+        }
+
+
+retrieval_pool = RetrievalPool(
+    workers=int(os.getenv("RAG_WORKERS", "4")),
+    max_in_flight=int(os.getenv("RAG_MAX_IN_FLIGHT", "8")),
+)
+metrics.register("rag_retrieval", retrieval_pool.stats)
+metrics.register("rag_answer_cache", answer_cache.stats)
+metrics.register("rag_indexes", registry.stats)
+
+
+def retrieve(
+    question: str, model: str, user_id: str | None
+) -> tuple[int, str, np.ndarray, str | None, list[dict]]:
+    """
+    Blocking half of `get_brain`: embed the question, then either find a cached
+    answer or search the index. Returns (index version, cache scope, query,
+    answer, chunks).
+    """
+    retriever = get_retriever(user_id)
+    # Answers are cached per index and per chat model.
+    scope = f"{retriever.index_dir}:{model}"
+    query = retriever.embed([question])[0]
+    answer = answer_cache.get(query, retriever.version, scope)
+    if answer is not None:
+        return retriever.version, scope, query, answer, []
+    chunks = retriever.search_batch([question], queries=query[None])[0]
+    return retriever.version, scope, query, None, chunks
+
+
+async def get_brain(
+    question: str,
+    llm: BaseChatModel,
+    user_id: str | None = None,
+    config: RunnableConfig | None = None,
+) -> str:
+    """
+    Answer question from the knowledge base. Retrieval finishes first, then the
+    answer is generated with a streaming call under config, so inside a graph
+    node its tokens reach /stream as on_chat_model_stream events.
+    """
+    model = getattr(llm, "model_name", None) or getattr(llm, "model", "")
+    version, scope, query, answer, chunks = await retrieval_pool.run(
+        retrieve, question, model, user_id
     )
-    res = brain.ask(question)
+    if answer is not None:
+        return answer
 
-    return res.answer
+    messages = [
+        SystemMessage(content=rag_instructions.format(context=format_context(chunks))),
+        HumanMessage(content=question),
+    ]
+    res = None
+    async for chunk in llm.astream(messages, config):
+        res = chunk if res is None else res + chunk
+    content = "" if res is None else res.content
+    if not isinstance(content, str):
+        # Anthropic streams a list of content blocks
+        content = "".join(c if isinstance(c, str) else c.get("text", "") for c in content)
+    answer_cache.put(query, content, version, scope)
+    return content
 
 
 if __name__ == "__main__":
     load_dotenv()
-    # data_dir = '/Users/zhangsu/workspace/tmp/data'
-    res = get_brain("what is my dream about?")
-    print(res)
+    parser = argparse.ArgumentParser(description="Build or query the RAG index.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    build_parser = subparsers.add_parser("build", help="index new and changed files in the data dir")
+    build_parser.add_argument("--data-dir", default=get_data_dir())
+    build_parser.add_argument("--index-dir", default=get_index_dir())
+    build_parser.add_argument("--full", action="store_true", help="re-embed every file")
+    build_parser.add_argument("--user", help="build the knowledge base of this user_id")
+    compact_parser = subparsers.add_parser("compact", help="drop tombstoned rows")
+    compact_parser.add_argument("--data-dir", default=get_data_dir())
+    compact_parser.add_argument("--index-dir", default=get_index_dir())
+    compact_parser.add_argument("--user", help="compact the knowledge base of this user_id")
+    ask_parser = subparsers.add_parser("ask", help="answer a question from the index")
+    ask_parser.add_argument("question")
+    ask_parser.add_argument("--user", help="ask the knowledge base of this user_id")
+    args = parser.parse_args()
+
+    if args.command != "ask" and args.user:
+        args.data_dir = tenant_dir(args.data_dir, args.user)
+        args.index_dir = tenant_dir(args.index_dir, args.user)
+    if args.command == "build":
+        stats = update_index(args.data_dir, args.index_dir, full=args.full)
+        print(f"Updated {args.index_dir}: {stats}")
+    elif args.command == "compact":
+        stats = update_index(args.data_dir, args.index_dir, force_compact=True)
+        print(f"Compacted {args.index_dir}: {stats}")
+    else:
+        from agents.models import models
+
+        print(asyncio.run(get_brain(args.question, models["gpt-4o-mini"], args.user)))
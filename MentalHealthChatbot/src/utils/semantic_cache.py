@@ -0,0 +1,120 @@
+"""
+Semantic answer cache for the psychologist RAG call.
+
+Patients often ask nearly the same question ("how do I cope with work stress").
+Answers are keyed by the L2-normalized question embedding and served for any
+new question whose cosine similarity to a cached one is at least `threshold`.
+
+Entries expire after `ttl` seconds, the least recently used entries are evicted
+once the cache holds more than `max_bytes`, and the entries of a scope (one
+index and chat model) are dropped whenever that index's version changes.
+"""
+import threading
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+
+import numpy as np
+
+# Rough per-entry bookkeeping cost on top of the embedding and the answer text
+ENTRY_OVERHEAD = 200
+
+
+@dataclass
+class CacheEntry:
+    slot: int
+    scope: str
+    answer: str
+    expires_at: float
+    size: int
+
+
+class SemanticCache:
+    def __init__(self, threshold: float = 0.95, max_bytes: int = 16 << 20, ttl: float = 3600) -> None:
+        self.threshold = threshold
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._clear()
+
+    def _clear(self) -> None:
+        self._entries: OrderedDict[int, CacheEntry] = OrderedDict()
+        self._versions: dict[str, int] = {}
+        self._matrix = np.zeros((0, 0), dtype=np.float32)
+        self._used = np.zeros(0, dtype=bool)
+        self._bytes = 0
+
+    def _check_version(self, version: int, scope: str) -> None:
+        if self._versions.get(scope, version) != version:
+            for entry in [e for e in self._entries.values() if e.scope == scope]:
+                self._evict(entry.slot)
+        self._versions[scope] = version
+
+    def _evict(self, slot: int) -> None:
+        entry = self._entries.pop(slot)
+        self._used[slot] = False
+        self._bytes -= entry.size
+
+    def get(self, embedding: np.ndarray, version: int, scope: str = "") -> str | None:
+        """Return a cached answer for a similar question, or None."""
+        with self._lock:
+            self._check_version(version, scope)
+            if self._entries:
+                scores = np.where(self._used, self._matrix @ embedding, -np.inf)
+                now = time.monotonic()
+                for slot in np.argsort(-scores).tolist():
+                    if scores[slot] < self.threshold:
+                        break
+                    entry = self._entries[slot]
+                    if entry.expires_at < now:
+                        self._evict(slot)
+                        continue
+                    if entry.scope == scope:
+                        self._entries.move_to_end(slot)
+                        self.hits += 1
+                        return entry.answer
+            self.misses += 1
+            return None
+
+    def put(self, embedding: np.ndarray, answer: str, version: int, scope: str = "") -> None:
+        embedding = np.asarray(embedding, dtype=np.float32)
+        size = embedding.nbytes + len(answer.encode("utf-8")) + ENTRY_OVERHEAD
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            self._check_version(version, scope)
+            while self._bytes + size > self.max_bytes:
+                self._evict(next(iter(self._entries)))
+                self.evictions += 1
+
+            free = np.flatnonzero(~self._used)
+            if len(free):
+                slot = int(free[0])
+            else:
+                # Grow the slot matrix geometrically so lookups stay one matmul.
+                slot = len(self._used)
+                capacity = max(16, 2 * slot)
+                matrix = np.zeros((capacity, len(embedding)), dtype=np.float32)
+                if slot:
+                    matrix[:slot] = self._matrix
+                self._matrix = matrix
+                self._used = np.concatenate([self._used, np.zeros(capacity - slot, dtype=bool)])
+            self._matrix[slot] = embedding
+            self._used[slot] = True
+            self._entries[slot] = CacheEntry(slot, scope, answer, time.monotonic() + self.ttl, size)
+            self._bytes += size
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "scopes": len(self._versions),
+        }
@@ -0,0 +1,138 @@
+"""
+Dependency-light vector store for the RAG index.
+
+The embedding matrix is a float32 .npy file opened with np.memmap, so every
+uvicorn worker on a host shares one page-cached copy of it instead of holding
+its own. Chunk metadata lives in a JSON-lines side table that is read by byte
+offset, one row at a time, only for the rows a query returns.
+
+Queries are answered with one matmul over the whole matrix and argpartition,
+and may be batched.
+
+Benchmark query latency against synthetic indexes:
+
+    $ cd src; poetry run python -m utils.vector_store --sizes 10000 100000 1000000
+"""
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+from typing import BinaryIO
+
+import numpy as np
+
+
+def normalize(vectors: np.ndarray) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+def open_npy(path: str, dtype: type, count: int) -> BinaryIO:
+    """Open a 1-D .npy file of `count` values for writing them as raw bytes, in order."""
+    f = open(path, "wb")
+    header = {"descr": np.lib.format.dtype_to_descr(np.dtype(dtype)), "fortran_order": False, "shape": (count,)}
+    np.lib.format.write_array_header_1_0(f, header)
+    return f
+
+
+def raw_to_npy(raw_path: str, path: str, dtype: type, count: int) -> None:
+    """Turn a file of `count` raw values into a 1-D .npy file without loading it, then remove it."""
+    with open_npy(path, dtype, count) as out, open(raw_path, "rb") as raw:
+        shutil.copyfileobj(raw, out, 1 << 20)
+    os.remove(raw_path)
+
+
+class VectorStore:
+    def __init__(
+        self,
+        embeddings_path: str,
+        chunks_path: str,
+        offsets_path: str,
+        deleted: list[int] = [],
+    ) -> None:
+        self.embeddings = np.load(embeddings_path, mmap_mode="r")
+        self.offsets = np.load(offsets_path, mmap_mode="r")
+        self.chunks_path = chunks_path
+        self.live = np.ones(len(self.offsets), dtype=bool)
+        self.live[deleted] = False
+        self.live_count = int(self.live.sum())
+        self.deleted = np.flatnonzero(~self.live)
+
+    def __len__(self) -> int:
+        return self.live_count
+
+    def get(self, row: int) -> dict:
+        with open(self.chunks_path, "rb") as f:
+            f.seek(int(self.offsets[row]))
+            return json.loads(f.readline())
+
+    def search(self, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Top-k cosine search for a (batch, dim) array of L2-normalized queries.
+
+        Returns (rows, scores), both (batch, k') with k' = min(k, live rows),
+        best match first.
+        """
+        queries = np.atleast_2d(np.asarray(queries, dtype=np.float32))
+        k = min(k, self.live_count)
+        if k == 0:
+            return np.zeros((len(queries), 0), dtype=np.int64), np.zeros((len(queries), 0), dtype=np.float32)
+        scores = queries @ self.embeddings.T
+        if len(self.deleted):
+            scores[:, self.deleted] = -np.inf
+        if k < scores.shape[1]:
+            top = np.argpartition(scores, -k, axis=1)[:, -k:]
+        else:
+            top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+        top_scores = np.take_along_axis(scores, top, axis=1)
+        order = np.argsort(-top_scores, axis=1)
+        return np.take_along_axis(top, order, axis=1), np.take_along_axis(top_scores, order, axis=1)
+
+
+def _build_synthetic(index_dir: str, size: int, dim: int, block: int = 50_000) -> VectorStore:
+    rng = np.random.default_rng(0)
+    embeddings_path = os.path.join(index_dir, f"embeddings.{size}.npy")
+    matrix = np.lib.format.open_memmap(embeddings_path, mode="w+", dtype=np.float32, shape=(size, dim))
+    for start in range(0, size, block):
+        rows = rng.standard_normal((min(block, size - start), dim), dtype=np.float32)
+        matrix[start : start + len(rows)] = rows / np.linalg.norm(rows, axis=1, keepdims=True)
+    matrix.flush()
+    del matrix
+    offsets_path = os.path.join(index_dir, f"offsets.{size}.npy")
+    np.save(offsets_path, np.zeros(size, dtype=np.int64))
+    return VectorStore(embeddings_path, os.devnull, offsets_path)
+
+
+def benchmark(sizes: list[int], dim: int, k: int, batch: int, repeats: int) -> None:
+    rng = np.random.default_rng(1)
+    with tempfile.TemporaryDirectory() as index_dir:
+        for size in sizes:
+            store = _build_synthetic(index_dir, size, dim)
+            queries = rng.standard_normal((repeats, batch, dim), dtype=np.float32)
+            queries /= np.linalg.norm(queries, axis=2, keepdims=True)
+            store.search(queries[0], k)  # warm the page cache
+            latencies = []
+            for q in queries:
+                start = time.perf_counter()
+                store.search(q, k)
+                latencies.append((time.perf_counter() - start) * 1000)
+            p50, p95 = np.percentile(latencies, [50, 95])
+            print(
+                f"chunks={size:>9,} dim={dim} batch={batch} k={k}: "
+                f"p50={p50:8.2f} ms  p95={p95:8.2f} ms  per query={p50 / batch:8.2f} ms"
+            )
+            del store
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark VectorStore query latency.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10_000, 100_000, 1_000_000])
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--batch", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=20)
+    args = parser.parse_args()
+    benchmark(args.sizes, args.dim, args.k, args.batch, args.repeats)